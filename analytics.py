@@ -0,0 +1,186 @@
+ROLLING_DAYS = 7  # window for the rolling daily total
+DAILY_HISTORY_DAYS = 90  # days of rolling totals charted
+WEEKLY_HISTORY_WEEKS = 26  # weeks of weekly totals charted
+ITEM_TREND_DAYS = 28  # item trends compare the last 28 days against the 28 before
+ITEM_TREND_TOP = 10  # items listed per store
+TOP_ITEMS = 10  # items in the all-time most wasted chart
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+SHEETS_EPOCH = '1899-12-30'  # day 0 of a Sheets date serial number
+
+
+# Sheet1 rows read with UNFORMATTED_VALUE/SERIAL_NUMBER: [date serial, store, item, count].
+# everything below is column-wise pandas work, so the cost stays in C even for millions of rows
+def waste_frame(rows):
+    import pandas as pd
+
+    frame = pd.DataFrame([row[:4] for row in rows if len(row) >= 4],
+                         columns=['date', 'store', 'item', 'count'])
+    frame['date'] = pd.to_datetime(pd.to_numeric(frame['date'], errors='coerce'),
+                                   unit='D', origin=SHEETS_EPOCH)
+    frame['count'] = pd.to_numeric(frame['count'], errors='coerce')
+    frame = frame.dropna(subset=['date', 'count'])
+    frame['store'] = frame['store'].astype(str).astype('category')
+    frame['item'] = frame['item'].astype(str).str.strip()
+    return frame[frame['item'] != '']
+
+
+# all-time totals for the store donut and the top items chart: (store names,
+# [[store, total]], [[item, count for each store]] for the TOP_ITEMS most wasted items)
+def all_time_totals(frame):
+    if frame.empty:
+        return [], [], []
+    by_item = frame.pivot_table(index='item', columns='store', values='count',
+                                aggfunc='sum', fill_value=0, observed=True)
+    stores = [str(store) for store in by_item.columns]
+    store_rows = [[store, int(total)] for store, total in zip(stores, by_item.sum().to_numpy())]
+    top = by_item.loc[by_item.sum(axis=1).nlargest(TOP_ITEMS).index]
+    item_rows = [[item] + [int(count) for count in counts] for item, counts in zip(top.index, top.to_numpy())]
+    return stores, store_rows, item_rows
+
+
+def table_values(frame, index_name, index_format=None):
+    index = frame.index.strftime(index_format) if index_format else frame.index
+    header = [index_name] + [str(column) for column in frame.columns]
+    rows = [[label] + [round(float(value), 2) for value in values]
+            for label, values in zip(index, frame.to_numpy())]
+    return [header] + rows
+
+
+# returns {name: values} for each trend table; values include a header row
+def compute_trends(frame):
+    import pandas as pd
+
+    daily = frame.pivot_table(index='date', columns='store', values='count',
+                              aggfunc='sum', fill_value=0, observed=True)
+    daily = daily.asfreq('D', fill_value=0)
+
+    rolling = daily.rolling(ROLLING_DAYS, min_periods=1).sum().tail(DAILY_HISTORY_DAYS)
+    weekly = daily.resample('W-SUN').sum().tail(WEEKLY_HISTORY_WEEKS)
+    by_weekday = daily.groupby(daily.index.dayofweek).mean().reindex(range(7), fill_value=0)
+    by_weekday.index = WEEKDAYS
+
+    end = frame['date'].max()
+    recent_start = end - pd.Timedelta(days=ITEM_TREND_DAYS - 1)
+    prior_start = recent_start - pd.Timedelta(days=ITEM_TREND_DAYS)
+    period = (frame['date'] >= recent_start).map({True: 'recent', False: 'prior'})
+    in_window = frame['date'] >= prior_start
+    items = (frame[in_window]
+             .assign(period=period[in_window])
+             .pivot_table(index=['store', 'item'], columns='period', values='count',
+                          aggfunc='sum', fill_value=0, observed=True)
+             .reindex(columns=['recent', 'prior'], fill_value=0))
+    items['change'] = items['recent'] - items['prior']
+    items = (items.sort_values(['recent', 'change'], ascending=False)
+             .groupby(level='store', observed=True)
+             .head(ITEM_TREND_TOP)
+             .sort_index(level='store', sort_remaining=False))
+
+    item_rows = [['Store', 'Menu Item', f'Last {ITEM_TREND_DAYS} Days', f'Prior {ITEM_TREND_DAYS} Days', 'Change']]
+    item_rows += [[str(store), item, int(recent), int(prior), int(change)]
+                  for (store, item), (recent, prior, change)
+                  in zip(items.index, items[['recent', 'prior', 'change']].to_numpy())]
+
+    return {
+        'rolling': table_values(rolling, 'Date', '%m/%d/%Y'),
+        'weekly': table_values(weekly, 'Week Ending', '%m/%d/%Y'),
+        'weekday': table_values(by_weekday, 'Day'),
+        'items': item_rows
+    }
+
+
+def chart_request(title, chart_type, data_sheet_id, start_column, table, anchor_sheet_id,
+                  anchor_row, anchor_column, width=600):
+    row_count = len(table)
+    series_count = len(table[0]) - 1
+    return {
+        "addChart": {
+            "chart": {
+                "spec": {
+                    "title": title,
+                    "basicChart": {
+                        "chartType": chart_type,
+                        "legendPosition": "BOTTOM_LEGEND",
+                        "headerCount": 1,
+                        "domains": [{
+                            "domain": {
+                                "sourceRange": {
+                                    "sources": [{
+                                        "sheetId": data_sheet_id,
+                                        "startRowIndex": 0,
+                                        "endRowIndex": row_count,
+                                        "startColumnIndex": start_column,
+                                        "endColumnIndex": start_column + 1,
+                                    }]
+                                }
+                            }
+                        }],
+                        "series": [
+                            {
+                                "series": {
+                                    "sourceRange": {
+                                        "sources": [{
+                                            "sheetId": data_sheet_id,
+                                            "startRowIndex": 0,
+                                            "endRowIndex": row_count,
+                                            "startColumnIndex": start_column + i + 1,
+                                            "endColumnIndex": start_column + i + 2,
+                                        }]
+                                    }
+                                },
+                                "targetAxis": "LEFT_AXIS"
+                            }
+                            for i in range(series_count)
+                        ],
+                    },
+                },
+                "position": {
+                    "overlayPosition": {
+                        "anchorCell": {
+                            "sheetId": anchor_sheet_id,
+                            "rowIndex": anchor_row,
+                            "columnIndex": anchor_column
+                        },
+                        "widthPixels": width,
+                        "heightPixels": 400
+                    }
+                }
+            }
+        }
+    }
+
+
+# writes the trend tables and returns the addChart requests for them, or [] when
+# pandas isn't installed or there's nothing to chart. the series tables go side by
+# side on the hidden trend_sheet, the item table on the visible Analytics tab
+def update_trend_data(service, spreadsheet_id, frame, trend_sheet, trend_sheet_id, analytics_sheet_id):
+    if frame.empty:
+        return []
+    trends = compute_trends(frame)
+
+    columns = {}
+    next_column = 0
+    for name in ['rolling', 'weekly', 'weekday']:
+        columns[name] = next_column
+        next_column += len(trends[name][0]) + 1
+
+    data = [{'range': f"{trend_sheet}!R1C{columns[name] + 1}", 'values': trends[name]}
+            for name in columns]
+    data.append({'range': "Analytics!A66", 'values': [["Item Trends by Store"]] + trends['items']})
+
+    service.spreadsheets().values().batchClear(
+        spreadsheetId=spreadsheet_id,
+        body={'ranges': [trend_sheet, "Analytics!A66:E"]}
+    ).execute()
+    service.spreadsheets().values().batchUpdate(
+        spreadsheetId=spreadsheet_id,
+        body={'valueInputOption': 'RAW', 'data': data}
+    ).execute()
+
+    return [
+        chart_request(f"{ROLLING_DAYS}-Day Rolling Waste by Store", "LINE", trend_sheet_id,
+                      columns['rolling'], trends['rolling'], analytics_sheet_id, 22, 0, width=700),
+        chart_request("Weekly Waste by Store", "COLUMN", trend_sheet_id,
+                      columns['weekly'], trends['weekly'], analytics_sheet_id, 22, 8, width=800),
+        chart_request("Average Daily Waste by Day of Week", "COLUMN", trend_sheet_id,
+                      columns['weekday'], trends['weekday'], analytics_sheet_id, 44, 0, width=700),
+    ]
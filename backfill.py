@@ -0,0 +1,183 @@
+import main
+import email_access
+import data_process
+import run_state
+import tenants
+import message_status
+import ocr_scheduler
+import profiling
+import argparse
+import datetime
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+CHECKPOINT_DIR = 'backfill_checkpoints'
+BATCH_SIZE = 25
+
+
+# one shard = one store sender over one [after, before) date window
+def build_shards(start_date, end_date, shard_days, chains):
+    shards = []
+    window_start = start_date
+    while window_start < end_date:
+        window_end = min(window_start + datetime.timedelta(days=shard_days), end_date)
+        for chain in chains:
+            for store in chain['stores']:
+                for sender in store['senders']:
+                    shards.append({
+                        'key': f"{tenants.slugify(sender)}_{window_start:%Y%m%d}_{window_end:%Y%m%d}",
+                        'chain': chain['name'],
+                        'sender': sender,
+                        'after': window_start.isoformat(),
+                        'before': window_end.isoformat()
+                    })
+        window_start = window_end
+    return shards
+
+
+def shard_query(shard):
+    after = datetime.date.fromisoformat(shard['after'])
+    before = datetime.date.fromisoformat(shard['before'])
+    return f"from:{shard['sender']} after:{after:%Y/%m/%d} before:{before:%Y/%m/%d}"
+
+
+def checkpoint_path(shard):
+    return os.path.join(CHECKPOINT_DIR, f"{shard['key']}.json")
+
+
+def load_checkpoint(shard):
+    path = checkpoint_path(shard)
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+    return {'status': 'pending', 'committed': []}
+
+
+# write to a temp file and rename so a crash never leaves a half-written checkpoint
+def save_checkpoint(shard, state):
+    os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+    path = checkpoint_path(shard)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def process_shard(shard, chain, sheet_id):
+    state = load_checkpoint(shard)
+    if state['status'] == 'done':
+        logging.info(f"shard {shard['key']} already done, skipping")
+        return shard['key'], state['status']
+
+    try:
+        # workers never open a browser; backfill() made sure the token is usable before starting them
+        gmail_service = email_access.get_gmail_service(main.CLIENT_SECRET_FILE, interactive=False)
+        messages, complete = email_access.search_messages_with_status(gmail_service, shard_query(shard))
+
+        committed = set(state['committed'])
+        processed_emails = data_process.get_processed_emails(sheet_id, main.SERVICE_ACCOUNT_FILE)
+        dead_letters = message_status.MessageStatus().dead_letters()
+        pending = [msg['id'] for msg in messages
+                   if msg['id'] not in committed and msg['id'] not in processed_emails and msg['id'] not in dead_letters]
+        logging.info(f"shard {shard['key']}: {len(messages)} emails found, {len(pending)} left to process")
+
+        writer, deduplicator = main.open_writer(sheet_id, processed_emails, chain)
+        unfinished = 0
+        for i in range(0, len(pending), BATCH_SIZE):
+            batch_ids = pending[i:i + BATCH_SIZE]
+            img_attachments = email_access.get_images(gmail_service, batch_ids, gmail_service)
+            if img_attachments:
+                ok, _ = main.stage_batch(writer, deduplicator, img_attachments, chain, batch_ids)
+                if not (ok and writer.flush()):
+                    # this batch goes to the retry queue, the rest of the shard carries on
+                    writer.dead_letter("sheet append failed")
+
+            # only emails that were written or dead-lettered are checkpointed; ones that
+            # couldn't be fetched stay pending for the next run of this range
+            status = writer.statuses.status_of(batch_ids)
+            done_ids = [msg_id for msg_id in batch_ids if status.get(msg_id) in message_status.FINAL]
+            unfinished += len(batch_ids) - len(done_ids)
+            committed.update(done_ids)
+            state['committed'] = sorted(committed)
+            save_checkpoint(shard, state)
+            logging.info(f"shard {shard['key']}: checkpointed {len(committed)} emails")
+
+        ocr_scheduler.log_prefilter_summary()
+        if unfinished:
+            logging.warning(f"shard {shard['key']}: {unfinished} emails weren't processed, rerun to pick them up")
+        # a rate-limited search may have missed messages, so leave the shard open for the next run
+        state['status'] = 'done' if complete and not unfinished else 'partial'
+        save_checkpoint(shard, state)
+        return shard['key'], state['status']
+
+    except Exception as e:
+        logging.error(f"error processing shard {shard['key']}: {str(e)}", exc_info=True)
+        state['status'] = 'failed'
+        save_checkpoint(shard, state)
+        return shard['key'], state['status']
+    finally:
+        # pool workers exit without running atexit hooks, so each shard writes its profile
+        profiling.write_reports()
+
+
+# the parent builds its sheets and drive clients before forking, and an
+# httplib2 connection can't be shared between processes, so each worker
+# starts with empty client caches and builds its own
+def init_worker():
+    data_process.get_sheets_service.cache_clear()
+    data_process.get_drive_service.cache_clear()
+    main.setup_logging()
+
+
+def backfill(start_date, end_date, shard_days=7, workers=4):
+    # sign in (or refresh) once up front, so workers find a fresh token on disk
+    email_access.get_gmail_service(main.CLIENT_SECRET_FILE)
+
+    chains = {}
+    sheet_ids = {}
+    for chain in tenants.load_tenants():
+        sheet_id = main.get_chain_sheet(chain)
+        if not sheet_id:
+            logging.error(f"failed to get or create spreadsheet for {chain['name']}, skipping it")
+            continue
+        chains[chain['name']] = chain
+        sheet_ids[chain['name']] = sheet_id
+        # seed the dedup index once here rather than racing to do it in every worker
+        data_process.get_dedup_index(sheet_id, main.SERVICE_ACCOUNT_FILE)
+
+    shards = build_shards(start_date, end_date, shard_days, chains.values())
+    logging.info(f"backfilling {start_date} to {end_date} in {len(shards)} shards with {workers} workers")
+
+    statuses = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        futures = [executor.submit(process_shard, shard, chains[shard['chain']], sheet_ids[shard['chain']])
+                   for shard in shards]
+        for future in as_completed(futures):
+            key, status = future.result()
+            statuses[key] = status
+            logging.info(f"shard {key} finished with status: {status}")
+
+    done = sum(1 for status in statuses.values() if status == 'done')
+    logging.info(f"backfill finished: {done} of {len(shards)} shards done")
+    if done < len(shards):
+        logging.warning("some shards are incomplete - rerun the same backfill to resume them")
+
+    for name, chain in chains.items():
+        main.refresh_outputs(sheet_ids[name], run_state.load_run_state(chain['state_file']), chain)
+    profiling.write_reports()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="reprocess a date range of emails in resumable shards")
+    parser.add_argument('--start', required=True, type=datetime.date.fromisoformat, help="first day, YYYY-MM-DD")
+    parser.add_argument('--end', required=True, type=datetime.date.fromisoformat, help="day after the last day, YYYY-MM-DD")
+    parser.add_argument('--shard-days', type=int, default=7)
+    parser.add_argument('--workers', type=int, default=4)
+    main.add_profile_argument(parser)
+    args = parser.parse_args()
+    main.apply_profile_argument(args)
+
+    main.setup_logging()
+    backfill(args.start, args.end, args.shard_days, args.workers)
@@ -0,0 +1,110 @@
+import argparse
+import datetime
+import logging
+import random
+import subprocess
+import sys
+import time
+
+
+# runs `python -X importtime -c "import <module>"` in a fresh interpreter and
+# returns (total_us, [(cumulative_us, module), ...]) for the top-level imports.
+# raises RuntimeError with the import's error when the module can't be imported
+def measure_import_time(module):
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0:
+        errors = [line for line in result.stderr.splitlines() if not line.startswith('import time:')]
+        raise RuntimeError(errors[-1] if errors else f"exit status {result.returncode}")
+
+    top_level = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, name = line.split('|')
+        # nested imports are indented under the module that pulled them in
+        if name.startswith('  '):
+            continue
+        top_level.append((int(cumulative_us), name.strip()))
+
+    total = sum(cumulative_us for cumulative_us, _ in top_level)
+    return total, sorted(top_level, reverse=True)
+
+
+def bench_cold_start(top=10):
+    print("cold start (python -X importtime)")
+    for module in ['main']:
+        try:
+            total, top_level = measure_import_time(module)
+        except RuntimeError as e:
+            print(f"  import {module} failed: {e}")
+            continue
+        print(f"  import {module}: {total / 1000:.1f} ms total")
+        for cumulative_us, name in top_level[:top]:
+            print(f"    {cumulative_us / 1000:8.1f} ms  {name}")
+
+
+SAMPLE_ITEMS = ['Croissantf $3.00', 'Almond Crx', 'Bluberry Muff', 'Ham & Cheese Rol', '100 Ww Loaf',
+                'Kouign Aman', 'Levain.00', 'Cook Le', 'Chocolate Bi Muff', 'Olive Ciabatta Ee (slice)']
+
+
+# receipt-style text: an "Ordered:" line, waste lines and some OCR noise
+def synthetic_receipt(rng, lines):
+    body = ["Take Out", f"Ordered: {rng.randint(1, 12)}/{rng.randint(1, 28)}/24 {rng.randint(1, 12)}:{rng.randint(10, 59)} PM"]
+    for _ in range(lines):
+        if rng.random() < 0.6:
+            body.append(f"{rng.randint(1, 20)} Wasted {rng.choice(SAMPLE_ITEMS)}")
+        else:
+            body.append(rng.choice(["Total: 5", "Thank you", "", "----"]))
+    return '\n'.join(body)
+
+
+# typed email body: greeting, a WASTE: header and "Item: N" lines
+def synthetic_email(rng, lines):
+    body = ["Hi team,", "", "**WASTE:**"]
+    for _ in range(lines):
+        body.append(f"{rng.choice(SAMPLE_ITEMS)}: {rng.randint(0, 12)}")
+    body.append("Thanks!")
+    return '\n'.join(body)
+
+
+def bench_parse_text(bodies=200, lines=500):
+    import img_process
+
+    rng = random.Random(0)
+    email_date = datetime.date(2024, 1, 2).toordinal()
+    logging.disable(logging.CRITICAL)
+    print("parse_text throughput")
+    for name, make_body in [('receipt', synthetic_receipt), ('email', synthetic_email)]:
+        texts = [make_body(rng, lines) for _ in range(bodies)]
+        total_lines = sum(text.count('\n') + 1 for text in texts)
+
+        start = time.perf_counter()
+        rows = sum(len(img_process.parse_text(text, email_date)) for text in texts)
+        elapsed = time.perf_counter() - start
+
+        print(f"  {name}: {total_lines} lines, {rows} rows in {elapsed:.2f}s "
+              f"({total_lines / elapsed:.0f} lines/sec)")
+    logging.disable(logging.NOTSET)
+
+
+BENCHMARKS = {
+    'cold_start': bench_cold_start,
+    'parse_text': bench_parse_text,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="breadbot micro-benchmarks")
+    parser.add_argument('names', nargs='*', help=f"benchmarks to run (default: all of {', '.join(BENCHMARKS)})")
+    args = parser.parse_args()
+
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(unknown)}")
+
+    for name in args.names or BENCHMARKS:
+        BENCHMARKS[name]()
@@ -0,0 +1,153 @@
+import main
+import email_access
+import data_process
+import run_state
+import tenants
+import forecast
+import message_status
+import ocr_scheduler
+import profiling
+import argparse
+import logging
+import signal
+import time
+from googleapiclient.errors import HttpError
+
+POLL_INTERVAL = 15  # seconds between mailbox history checks
+
+running = True
+
+
+def stop(signum, frame):
+    global running
+    logging.info(f"received signal {signum}, stopping after the current cycle")
+    running = False
+
+
+def process_new_emails(gmail_service, sheet, msg_ids, sender_map):
+    new_ids = [msg_id for msg_id in msg_ids if msg_id not in sheet['processed_emails']]
+    if not new_ids:
+        return
+
+    chain = sheet['chain']
+    logging.info(f"found {len(new_ids)} new emails to process for {chain['name']}")
+    writer, deduplicator = main.open_writer(sheet['sheet_id'], sheet['processed_emails'], chain)
+    img_attachments = email_access.get_images(gmail_service, new_ids, gmail_service, sender_map)
+    if not img_attachments:
+        logging.warning("none of the emails could be fetched")
+    else:
+        ok, _ = main.stage_batch(writer, deduplicator, img_attachments, chain, new_ids)
+        ocr_scheduler.log_prefilter_summary()
+        if not (writer.close() and ok):
+            logging.error("failed to add new data to spreadsheet")
+        elif writer.rows_written or writer.counts_updated:
+            main.refresh_outputs(sheet['sheet_id'], run_state.load_run_state(chain['state_file']), chain)
+            forecast.update_forecast(sheet['sheet_id'], writer.written, chain['forecast_file'], main.SERVICE_ACCOUNT_FILE)
+
+    # the mailbox history has moved past these, so emails that couldn't be fetched
+    # go to the retry queue rather than waiting for the next restart's catch-up
+    status = writer.statuses.status_of(new_ids)
+    unfinished = [msg_id for msg_id in new_ids if status.get(msg_id) not in message_status.FINAL]
+    if unfinished:
+        writer.statuses.fail(unfinished, "could not be fetched", chain['name'])
+
+
+# history only tells us a message arrived, so route each one to its chain and drop anything not from a store.
+# returns ({chain name: [ids]}, whether every sender could be read); a deleted message counts as read
+def group_store_emails(gmail_service, msg_ids, sender_map):
+    by_chain = {}
+    complete = True
+    for msg_id in msg_ids:
+        try:
+            from_header = email_access.get_sender(gmail_service, msg_id)
+        except HttpError as e:
+            logging.error(f"error reading sender for email {msg_id}: {e}")
+            complete = complete and e.resp.status == 404
+            continue
+        route = tenants.resolve_sender(from_header, sender_map)
+        if route:
+            by_chain.setdefault(route[0], []).append(msg_id)
+    return by_chain, complete
+
+
+def catch_up(gmail_service, sheets, sender_map):
+    dead_letters = message_status.MessageStatus().dead_letters()
+    for sheet in sheets.values():
+        emails = email_access.search_messages(gmail_service, tenants.chain_query(sheet['chain']))
+        msg_ids = [msg['id'] for msg in emails if msg['id'] not in dead_letters]
+        # a long outage can leave a large backlog, so it goes through in batches like main.py's
+        for i in range(0, len(msg_ids), main.BATCH_SIZE):
+            process_new_emails(gmail_service, sheet, msg_ids[i:i + main.BATCH_SIZE], sender_map)
+
+
+def run(poll_interval=POLL_INTERVAL):
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    # clients, OCR modules and the processed lists stay loaded for the life of the process
+    logging.info("authenticating gmail...")
+    gmail_service = email_access.get_gmail_service(main.CLIENT_SECRET_FILE)
+
+    chains = tenants.load_tenants()
+    sender_map = tenants.build_sender_map(chains)
+    sheets = {}
+    for chain in chains:
+        sheet_id = main.get_chain_sheet(chain)
+        if not sheet_id:
+            logging.error(f"failed to get or create spreadsheet for {chain['name']}, skipping it")
+            continue
+        sheets[chain['name']] = {
+            'chain': chain,
+            'sheet_id': sheet_id,
+            'processed_emails': data_process.get_processed_emails(sheet_id, main.SERVICE_ACCOUNT_FILE)
+        }
+
+    history_id = email_access.get_history_id(gmail_service)
+    catch_up(gmail_service, sheets, sender_map)
+    logging.info(f"watching mailbox from history id {history_id}, polling every {poll_interval}s")
+
+    while running:
+        try:
+            msg_ids, next_history_id = email_access.list_new_message_ids(gmail_service, history_id)
+            complete = True
+            if msg_ids:
+                by_chain, complete = group_store_emails(gmail_service, msg_ids, sender_map)
+                for chain_name, chain_ids in by_chain.items():
+                    if chain_name in sheets:
+                        process_new_emails(gmail_service, sheets[chain_name], chain_ids, sender_map)
+            # only move past these messages once they were all routed and processed; an
+            # error above leaves the old history id, so the next poll lists them again
+            if complete:
+                history_id = next_history_id
+            else:
+                logging.warning("some senders couldn't be read, listing these messages again next poll")
+
+        except HttpError as e:
+            if e.resp.status == 404:
+                # history id expired (gmail keeps roughly a week) - rescan and start over
+                logging.warning("mailbox history expired, running a full search")
+                history_id = email_access.get_history_id(gmail_service)
+                catch_up(gmail_service, sheets, sender_map)
+            else:
+                logging.error(f"http error while polling: {e}")
+        except Exception as e:
+            logging.error(f"error while polling: {str(e)}", exc_info=True)
+
+        # sleep in short steps so a stop signal is handled promptly
+        deadline = time.monotonic() + poll_interval
+        while running and time.monotonic() < deadline:
+            time.sleep(min(1, poll_interval))
+
+    logging.info("daemon stopped")
+    profiling.write_reports()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="run breadbot as a resident service that polls for new mail")
+    parser.add_argument('--interval', type=int, default=POLL_INTERVAL, help="seconds between mailbox checks")
+    main.add_profile_argument(parser)
+    args = parser.parse_args()
+    main.apply_profile_argument(args)
+
+    main.setup_logging()
+    run(args.interval)
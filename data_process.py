@@ -1,15 +1,45 @@
 import os
 import json
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 import logging 
-from collections import defaultdict
+import time
+import datetime
+import run_state
+import analytics
+import dedup
+import message_status
+from functools import lru_cache
+
+FLUSH_ROWS = 500  # buffered rows that trigger an append
+FLUSH_SECONDS = 30  # max time a row waits in the buffer
+CONFLICTS_TAB = 'Conflicts'  # flagged count conflicts, for a person to resolve
+CONFLICT_HEADER = ['Date', 'Location', 'Item', 'Kept Count', 'Reported Count', 'Email ID', 'Seen At']
+
+
+# clients are cached per credentials file so long-running processes reuse
+# one authenticated client instead of rebuilding it for every call.
+# google-auth and the discovery client are imported on first use, and the
+# bundled discovery docs are used instead of fetching them
+@lru_cache(maxsize=None)
+def get_sheets_service(credentials_file):
+    from google.oauth2.service_account import Credentials
+    from googleapiclient.discovery import build
+
+    creds = Credentials.from_service_account_file(credentials_file, scopes=['https://www.googleapis.com/auth/spreadsheets'])
+    return build('sheets', 'v4', credentials=creds, static_discovery=True)
+
+
+@lru_cache(maxsize=None)
+def get_drive_service(credentials_file):
+    from google.oauth2.service_account import Credentials
+    from googleapiclient.discovery import build
+
+    creds = Credentials.from_service_account_file(credentials_file, scopes=['https://www.googleapis.com/auth/drive.file'])
+    return build('drive', 'v3', credentials=creds, static_discovery=True)
 
 def get_processed_emails(sheet_id, credentials_file):
     try:
-        creds = Credentials.from_service_account_file(credentials_file, scopes=['https://www.googleapis.com/auth/spreadsheets'])
-        service = build('sheets', 'v4', credentials=creds)
+        service = get_sheets_service(credentials_file)
         
         try:
             result = service.spreadsheets().values().get(
@@ -50,8 +80,7 @@ def get_processed_emails(sheet_id, credentials_file):
 
 def update_processed_emails(sheet_id, email_ids, credentials_file):
     try:
-        creds = Credentials.from_service_account_file(credentials_file, scopes=['https://www.googleapis.com/auth/spreadsheets'])
-        service = build('sheets', 'v4', credentials=creds)
+        service = get_sheets_service(credentials_file)
         
         unique_email_ids = list(set(email_ids))
         values = [[email_id] for email_id in email_ids]
@@ -72,19 +101,25 @@ def update_processed_emails(sheet_id, email_ids, credentials_file):
         logging.error(f"error updating processed emails: {e}")
 
 
-def get_or_create_spreadsheet(title, credentials_file):
-    config_file = 'mb_inventory_config.json'
-    
+def get_or_create_spreadsheet(title, credentials_file, config_file='mb_inventory_config.json'):
+    service = get_sheets_service(credentials_file)
+
     if os.path.exists(config_file):
         with open(config_file, 'r') as f:
             config = json.load(f)
             sheet_id = config.get('sheet_id')
         if sheet_id:
             logging.info(f"using existing spreadsheet")
+            # sheets created before formatting moved here get it once
+            if not config.get('formatted'):
+                try:
+                    apply_column_formats(service, sheet_id)
+                    config['formatted'] = True
+                    with open(config_file, 'w') as f:
+                        json.dump(config, f)
+                except Exception as e:
+                    logging.error(f"error formatting spreadsheet columns: {e}")
             return sheet_id
-    
-    creds = Credentials.from_service_account_file(credentials_file, scopes=['https://www.googleapis.com/auth/spreadsheets'])
-    service = build('sheets', 'v4', credentials=creds)
 
     # create spreadsheet with two sheet tabs
     try:
@@ -111,111 +146,299 @@ def get_or_create_spreadsheet(title, credentials_file):
             body={'values': header}
         ).execute()
         
+        apply_column_formats(service, sheet_id)
+
         with open(config_file, 'w') as f:
-            json.dump({'sheet_id': sheet_id}, f)
+            json.dump({'sheet_id': sheet_id, 'formatted': True}, f)
         
         return sheet_id
     except Exception as e:
         logging.error(f"error creating spreadsheet: {e}")
         return None
 
-def update_google_sheets(sheet_id, new_data, credentials_file):
-    try:
-        creds = Credentials.from_service_account_file(credentials_file, scopes=['https://www.googleapis.com/auth/spreadsheets'])
-        service = build('sheets', 'v4', credentials=creds)
-
-        data_to_append = new_data[1:] if new_data and len(new_data) > 1 else []
-        
-        if data_to_append:
-            formatted_data = []
-            for row in data_to_append:
-                formatted_row = [
-                    f'=DATE({row[0].split("/")[2]}, {row[0].split("/")[0]}, {row[0].split("/")[1]})',  # Date formula
-                    row[1] if len(row) > 1 else '',  # location
-                    row[2] if len(row) > 2 else '',  # menu item
-                    row[3] if len(row) > 3 else ''   # waste count
-                ]
-                formatted_data.append(formatted_row)
+# date and waste count formats cover the whole of columns A and D, so rows
+# appended later pick them up without another batchUpdate
+def apply_column_formats(service, sheet_id):
+    sheet_tab_id = get_sheet_id_by_name(service, sheet_id, 'Sheet1')
+    if sheet_tab_id is None:
+        return
 
-            body = {'values': formatted_data}
-            result = service.spreadsheets().values().append(
-                spreadsheetId=sheet_id,
-                range='Sheet1!A1',
-                valueInputOption='USER_ENTERED',
-                insertDataOption='INSERT_ROWS',
-                body=body
-            ).execute()
-            
-            updated_range = result.get('updates').get('updatedRange')
-            range_parts = updated_range.split('!')
-            if len(range_parts) > 1:              
-                sheet_tab_id = get_sheet_id_by_name(service, sheet_id, 'Sheet1')
-                if sheet_tab_id is not None:
-                    format_requests = {
-                        'requests': [
-                            {
-                                'repeatCell': {
-                                    'range': {
-                                        'sheetId': sheet_tab_id,  
-                                        'startColumnIndex': 0,
-                                        'endColumnIndex': 1,
-                                        'startRowIndex': 1  
-                                    },
-                                    'cell': {
-                                        'userEnteredFormat': {
-                                            'numberFormat': {
-                                                'type': 'DATE',
-                                                'pattern': 'MM/dd/yyyy'
-                                            }
-                                        }
-                                    },
-                                    'fields': 'userEnteredFormat.numberFormat'
-                                }
-                            },
-                            {
-                                'repeatCell': {
-                                    'range': {
-                                        'sheetId': sheet_tab_id, 
-                                        'startColumnIndex': 3,  
-                                        'endColumnIndex': 4,
-                                        'startRowIndex': 1  
-                                    },
-                                    'cell': {
-                                        'userEnteredFormat': {
-                                            'numberFormat': {
-                                                'type': 'NUMBER',
-                                                'pattern': '#,##0'
-                                            }
-                                        }
-                                    },
-                                    'fields': 'userEnteredFormat.numberFormat'
-                                }
+    format_requests = {
+        'requests': [
+            {
+                'repeatCell': {
+                    'range': {
+                        'sheetId': sheet_tab_id,  
+                        'startColumnIndex': 0,
+                        'endColumnIndex': 1,
+                        'startRowIndex': 1  
+                    },
+                    'cell': {
+                        'userEnteredFormat': {
+                            'numberFormat': {
+                                'type': 'DATE',
+                                'pattern': 'MM/dd/yyyy'
                             }
-                        ]
-                    }
-                    
-                    service.spreadsheets().batchUpdate(
-                        spreadsheetId = sheet_id,  
-                        body = format_requests
-                    ).execute()
-            
-            logging.info(f"appended {len(formatted_data)} new rows to the sheet")
+                        }
+                    },
+                    'fields': 'userEnteredFormat.numberFormat'
+                }
+            },
+            {
+                'repeatCell': {
+                    'range': {
+                        'sheetId': sheet_tab_id, 
+                        'startColumnIndex': 3,  
+                        'endColumnIndex': 4,
+                        'startRowIndex': 1  
+                    },
+                    'cell': {
+                        'userEnteredFormat': {
+                            'numberFormat': {
+                                'type': 'NUMBER',
+                                'pattern': '#,##0'
+                            }
+                        }
+                    },
+                    'fields': 'userEnteredFormat.numberFormat'
+                }
+            }
+        ]
+    }
+    
+    service.spreadsheets().batchUpdate(
+        spreadsheetId = sheet_id,  
+        body = format_requests
+    ).execute()
+
+
+# buffers WasteRecords (and the email ids they came from) and writes them as Sheet1 rows in
+# one append once FLUSH_ROWS rows are waiting or FLUSH_SECONDS have passed.
+# email ids are only recorded in ProcessedEmails after their rows are written.
+# with a dedup index, appended rows get their sheet row numbers recorded and
+# queued count corrections are written to those rows after the append, once the
+# row is re-read and still holds the same item. conflicts that need a person
+# go to the Conflicts tab.
+# with a status store, written emails are marked committed, and emails whose
+# rows still can't be written when the writer closes go to the dead-letter queue
+class SheetWriter:
+    def __init__(self, sheet_id, credentials_file, processed_emails=None, dedup_index=None, statuses=None,
+                 max_rows=FLUSH_ROWS, max_seconds=FLUSH_SECONDS):
+        self.sheet_id = sheet_id
+        self.credentials_file = credentials_file
+        self.processed_emails = processed_emails
+        self.dedup_index = dedup_index
+        self.statuses = statuses
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.rows = []
+        self.email_ids = []
+        self.count_updates = {}  # key -> (count, email id, count it replaces)
+        self.conflicts = []  # (key, kept count, reported count, email id, seen at)
+        self.dropped = []  # records replaced before they reached add()
+        self.written = []  # records appended to Sheet1 so far, for the forecast
+        self.last_flush = time.monotonic()
+        self.rows_written = 0
+        self.counts_updated = 0
+        self.seconds_writing = 0.0
+
+    # the records of a new batch that a later email in it didn't replace
+    def kept(self, records):
+        if not self.dropped:
+            return list(records)
+        records = [record for record in records if not any(record is dropped for dropped in self.dropped)]
+        self.dropped = []
+        return records
+
+    def add(self, records, email_ids=()):
+        self.rows.extend(self.kept(records))
+        self.email_ids.extend(email_ids)
+
+        if len(self.rows) >= self.max_rows or time.monotonic() - self.last_flush >= self.max_seconds:
+            return self.flush()
+        return True
+
+    # key is (location, date, normalized item), as built by dedup.row_key
+    def update_count(self, key, count, email_id=None, old_count=None):
+        self.count_updates[key] = (count, email_id, old_count)
+
+    def flag_conflict(self, key, kept_count, new_count, email_id):
+        self.conflicts.append((key, kept_count, new_count, email_id, datetime.datetime.now().isoformat()))
+
+    # forgets the count corrections and conflicts a failed email queued
+    def drop_queued(self, email_id):
+        self.count_updates = {key: update for key, update in self.count_updates.items() if update[1] != email_id}
+        self.conflicts = [conflict for conflict in self.conflicts if conflict[3] != email_id]
+
+    # takes a buffered record back out, or keeps it out of the next add() if its
+    # batch hasn't been queued yet. records are matched by identity, since two
+    # emails can report equal rows
+    def drop(self, record):
+        for position, row in enumerate(self.rows):
+            if row is record:
+                del self.rows[position]
+                return
+        self.dropped.append(record)
+
+    def restore(self, record):
+        for position, dropped in enumerate(self.dropped):
+            if dropped is record:
+                del self.dropped[position]
+                return
+        self.rows.append(record)
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if not self.rows and not self.email_ids and not self.count_updates and not self.conflicts:
             return True
-        else:
-            logging.info("no new data to append")
+
+        try:
+            service = get_sheets_service(self.credentials_file)
+            start = time.perf_counter()
+            if self.rows:
+                result = service.spreadsheets().values().append(
+                    spreadsheetId=self.sheet_id,
+                    range='Sheet1!A1',
+                    valueInputOption='USER_ENTERED',
+                    insertDataOption='INSERT_ROWS',
+                    body={'values': [record.sheet_values() for record in self.rows]}
+                ).execute()
+                first_row = dedup.first_row_of(result.get('updates', {}).get('updatedRange'))
+                if self.dedup_index is not None and first_row:
+                    self.dedup_index.set_rows(self.sheet_id, [dedup.record_key(record) for record in self.rows], first_row)
+            elapsed = time.perf_counter() - start
+        except Exception as e:
+            logging.error(f"error updating sheet: {e}")
             return False
-            
-    except Exception as e:
-        logging.error(f"error updating sheet: {e}")
-        return False
-    
+
+        if self.count_updates:
+            self.write_count_updates(service)
+        if self.conflicts:
+            self.write_conflicts(service)
+
+        self.rows_written += len(self.rows)
+        self.written.extend(self.rows)
+        self.seconds_writing += elapsed
+        if self.rows:
+            logging.info(f"appended {len(self.rows)} new rows to the sheet ({len(self.rows) / max(elapsed, 1e-6):.0f} rows/sec)")
+
+        if self.email_ids:
+            update_processed_emails(self.sheet_id, self.email_ids, self.credentials_file)
+            if self.processed_emails is not None:
+                self.processed_emails.update(self.email_ids)
+            if self.statuses is not None:
+                status = self.statuses.status_of(self.email_ids)
+                self.statuses.mark([email_id for email_id in self.email_ids if status.get(email_id) != message_status.NO_DATA],
+                                   message_status.COMMITTED)
+
+        self.rows = []
+        self.email_ids = []
+        return True
+
+    # row numbers come from the local index, and Sheet1 may have been sorted or
+    # edited since, so each target row is re-read first. a row that no longer
+    # holds the same item is flagged instead of overwritten
+    def write_count_updates(self, service):
+        targets = []
+        for key, update in self.count_updates.items():
+            row_number = self.dedup_index.sheet_row(self.sheet_id, key) if self.dedup_index else None
+            if row_number is None:
+                logging.warning(f"no sheet row recorded for {key}, can't update its count to {update[0]}")
+                continue
+            targets.append((key, row_number, update))
+
+        try:
+            data = []
+            if targets:
+                current = service.spreadsheets().values().batchGet(
+                    spreadsheetId=self.sheet_id, ranges=[f'Sheet1!A{row_number}:C{row_number}' for _, row_number, _ in targets]
+                ).execute().get('valueRanges', [])
+                for (key, row_number, (count, email_id, old_count)), value_range in zip(targets, current):
+                    row = (value_range.get('values') or [[]])[0]
+                    if len(row) < 3 or dedup.row_key(row[1], row[0], row[2]) != key:
+                        logging.warning(f"Sheet1 row {row_number} no longer holds {key}, flagging its count change to {count}")
+                        self.dedup_index.record_conflict(self.sheet_id, key, old_count, count, email_id)
+                        self.flag_conflict(key, old_count, count, email_id)
+                        continue
+                    data.append({'range': f'Sheet1!D{row_number}', 'values': [[count]]})
+
+            if data:
+                service.spreadsheets().values().batchUpdate(
+                    spreadsheetId=self.sheet_id,
+                    body={'valueInputOption': 'RAW', 'data': data}
+                ).execute()
+                logging.info(f"updated {len(data)} existing waste counts")
+                self.counts_updated += len(data)
+            self.count_updates = {}
+        except Exception as e:
+            logging.error(f"error updating waste counts: {e}")
+
+    def write_conflicts(self, service):
+        values = [[key[1], key[0], key[2], kept_count, new_count, email_id, seen_at]
+                  for key, kept_count, new_count, email_id, seen_at in self.conflicts]
+        try:
+            if get_sheet_id_by_name(service, self.sheet_id, CONFLICTS_TAB) is None:
+                ensure_sheet_tab(service, self.sheet_id, CONFLICTS_TAB)
+                values.insert(0, CONFLICT_HEADER)
+            service.spreadsheets().values().append(
+                spreadsheetId=self.sheet_id,
+                range=f'{CONFLICTS_TAB}!A1',
+                valueInputOption='RAW',
+                insertDataOption='INSERT_ROWS',
+                body={'values': values}
+            ).execute()
+            logging.warning(f"{len(self.conflicts)} conflicting waste counts need checking on the {CONFLICTS_TAB} tab")
+            self.conflicts = []
+        except Exception as e:
+            logging.error(f"error writing count conflicts: {e}")
+
+    def close(self):
+        ok = self.flush()
+        if not ok and self.statuses is not None:
+            self.dead_letter("sheet append failed")
+        if self.rows_written:
+            logging.info(f"wrote {self.rows_written} rows in {self.seconds_writing:.2f}s "
+                         f"({self.rows_written / max(self.seconds_writing, 1e-6):.0f} rows/sec)")
+        return ok
+
+
+    # drops the buffered rows, moving their emails to the dead-letter queue for retry.py
+    def dead_letter(self, reason):
+        email_ids = list(dict.fromkeys(self.email_ids))
+        self.statuses.fail(email_ids, reason)
+        if self.dedup_index is not None:
+            for email_id in email_ids:
+                self.dedup_index.discard_email(self.sheet_id, email_id)
+        self.rows = []
+        self.email_ids = []
+        self.count_updates = {}
+        self.conflicts = [conflict for conflict in self.conflicts if conflict[3] not in email_ids]
+
+
+# opens the local dedup index, seeding it from Sheet1 the first time a spreadsheet is seen
+def get_dedup_index(sheet_id, credentials_file):
+    index = dedup.DedupIndex()
+    if not index.has_sheet(sheet_id):
+        service = get_sheets_service(credentials_file)
+        sheet_rows = service.spreadsheets().values().get(
+            spreadsheetId=sheet_id, range='Sheet1!A2:D'
+        ).execute().get('values', [])
+        index.seed(sheet_id, sheet_rows)
+    return index
+
+
 def share_google_sheet(spreadsheet_id, email, credentials_file):
-    creds = Credentials.from_service_account_file(credentials_file, scopes=['https://www.googleapis.com/auth/drive.file'])
-    service = build('drive', 'v3', credentials=creds)
+    service = get_drive_service(credentials_file)
     
     try:
-        permissions = service.permissions().list(fileId=spreadsheet_id).execute()
-        logging.info(f"current permissions: {permissions}")
+        permissions = service.permissions().list(
+            fileId=spreadsheet_id,
+            fields='permissions(emailAddress)'
+        ).execute()
+        shared_emails = {permission.get('emailAddress', '').lower() for permission in permissions.get('permissions', [])}
+        if email.lower() in shared_emails:
+            logging.info(f"spreadsheet already shared with {email}")
+            return True
 
         request_body = {
             'role': 'writer',
@@ -229,38 +452,60 @@ def share_google_sheet(spreadsheet_id, email, credentials_file):
         ).execute()
         logging.info(f"sharing result: {result}")
 
-        # Verify the new permissions
-        new_permissions = service.permissions().list(fileId=spreadsheet_id).execute()
-        logging.info(f"updated permissions: {new_permissions}")
-
         logging.info(f"spreadsheet shared with {email}")    
         file = service.files().get(fileId=spreadsheet_id, fields='webViewLink').execute()
         logging.info(f"spreadsheet can be viewed at: {file.get('webViewLink')}")
+        return True
 
     except HttpError as error:
         logging.error(f"http error: {error}")
         logging.error(f"http error details: {error.content}")
     except Exception as e:
         logging.error(f"unexpected error in sharing: {e}")
+    return False
 
 
-def create_analytics_sheet(sheet_id, credentials_file):
+# returns the hash of the Sheet1 data the charts were built from; when it
+# matches last_data_hash the charts are already current and are left alone
+def create_analytics_sheet(sheet_id, credentials_file, last_data_hash=None):
     try:
-        creds = Credentials.from_service_account_file(
-            credentials_file,
-            scopes=["https://www.googleapis.com/auth/spreadsheets"],
-        )
-        service = build("sheets", "v4", credentials=creds)
+        service = get_sheets_service(credentials_file)
+
+        # raw values: dates as serial numbers and counts as numbers, for the trend analytics
+        waste_rows = service.spreadsheets().values().get(
+            spreadsheetId=sheet_id,
+            range="Sheet1!A2:D",
+            valueRenderOption="UNFORMATTED_VALUE",
+            dateTimeRenderOption="SERIAL_NUMBER"
+        ).execute().get("values", [])
+
+        data_hash = run_state.hash_values(waste_rows)
+        if data_hash == last_data_hash:
+            logging.info(f"sheet data unchanged ({len(waste_rows)} rows), skipping analytics refresh")
+            return data_hash
+
+        try:
+            import pandas  # noqa: F401
+        except ImportError:
+            # the old hash is kept, so the charts are built once pandas is installed
+            logging.warning("pandas is not installed, skipping analytics charts")
+            return last_data_hash
+
+        frame = analytics.waste_frame(waste_rows)
+        store_names, store_totals, top_items = analytics.all_time_totals(frame)
 
         response = service.spreadsheets().get(spreadsheetId=sheet_id).execute()
         analytics_sheet_id = None
         chart_data_sheet_id = None
+        trend_data_sheet_id = None
         
         for sheet in response["sheets"]:
             if sheet["properties"]["title"] == "Analytics":
                 analytics_sheet_id = sheet["properties"]["sheetId"]
             elif sheet["properties"]["title"] == "ChartData":
                 chart_data_sheet_id = sheet["properties"]["sheetId"]
+            elif sheet["properties"]["title"] == "TrendData":
+                trend_data_sheet_id = sheet["properties"]["sheetId"]
 
         requests = []
         if not analytics_sheet_id:
@@ -278,6 +523,15 @@ def create_analytics_sheet(sheet_id, credentials_file):
                     }
                 }
             })
+        if trend_data_sheet_id is None:
+            requests.append({
+                "addSheet": {
+                    "properties": {
+                        "title": "TrendData",
+                        "hidden": True
+                    }
+                }
+            })
 
         if requests:
             result = service.spreadsheets().batchUpdate(
@@ -292,6 +546,8 @@ def create_analytics_sheet(sheet_id, credentials_file):
                         analytics_sheet_id = props["sheetId"]
                     elif props["title"] == "ChartData":
                         chart_data_sheet_id = props["sheetId"]
+                    elif props["title"] == "TrendData":
+                        trend_data_sheet_id = props["sheetId"]
 
         existing_charts = service.spreadsheets().get(
             spreadsheetId=sheet_id
@@ -309,30 +565,6 @@ def create_analytics_sheet(sheet_id, credentials_file):
                             },
                         ).execute()
 
-        sheet1_data = service.spreadsheets().values().get(
-            spreadsheetId=sheet_id, range="Sheet1!B2:D"
-        ).execute().get("values", [])
-
-        # pie chart data prep
-        location_totals = defaultdict(int)
-        for row in sheet1_data:
-            if len(row) >= 3 and row[2].isdigit():
-                location_totals[row[0]] += int(row[2])
-
-        # stacked bar data prep
-        store_names = sorted({row[0] for row in sheet1_data if len(row) >= 1})
-        
-        store_item_totals = defaultdict(lambda: defaultdict(int))
-        for row in sheet1_data:
-            if len(row) >= 3 and row[2].isdigit():
-                store_item_totals[row[1]][row[0]] += int(row[2])
-
-        item_totals = {item: sum(store_counts.values()) 
-                      for item, store_counts in store_item_totals.items()
-                      if item and item.strip()}
-        
-        top_items = sorted(item_totals.items(), key=lambda x: x[1], reverse=True)[:10]
-
         service.spreadsheets().values().clear(
             spreadsheetId=sheet_id,
             range="ChartData!A:Z"
@@ -345,19 +577,13 @@ def create_analytics_sheet(sheet_id, credentials_file):
             body={
                 "values": [
                     ["Store", "Total Waste"],
-                    *[[store, location_totals[store]] for store in store_names]
+                    *store_totals
                 ]
             }
         ).execute()
 
         # top items data
-        headers = ["Menu Item"] + store_names
-        chart_data = [headers]
-        for item, _ in top_items:
-            row = [item]
-            for store in store_names:
-                row.append(store_item_totals[item].get(store, 0))
-            chart_data.append(row)
+        chart_data = [["Menu Item"] + store_names] + top_items
 
         service.spreadsheets().values().update(
             spreadsheetId=sheet_id,
@@ -497,21 +723,46 @@ def create_analytics_sheet(sheet_id, credentials_file):
             }
         ]
 
+        # rolling, weekly and day-of-week trend charts
+        chart_requests += analytics.update_trend_data(
+            service, sheet_id, frame, "TrendData", trend_data_sheet_id, analytics_sheet_id
+        )
+
         service.spreadsheets().batchUpdate(
             spreadsheetId=sheet_id,
             body={"requests": chart_requests}
         ).execute()
 
         print("analytics sheet updated successfully!")
+        return data_hash
 
     except Exception as e:
         print(f"error updating analytics sheet: {e}")
         raise e
 
 
+def ensure_sheet_tab(service, spreadsheet_id, title, hidden=False):
+    tab_id = get_sheet_id_by_name(service, spreadsheet_id, title)
+    if tab_id is None:
+        result = service.spreadsheets().batchUpdate(
+            spreadsheetId=spreadsheet_id,
+            body={"requests": [{"addSheet": {"properties": {"title": title, "hidden": hidden}}}]}
+        ).execute()
+        tab_id = result["replies"][0]["addSheet"]["properties"]["sheetId"]
+        tab_id_cache[(spreadsheet_id, title)] = tab_id
+    return tab_id
+
+
+# tab ids never change once a tab exists, so each lookup hits the API once
+tab_id_cache = {}
+
 def get_sheet_id_by_name(service, spreadsheet_id, sheet_name):
-    spreadsheet = service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
-    for sheet in spreadsheet['sheets']:
-        if sheet['properties']['title'] == sheet_name:
-            return sheet['properties']['sheetId']
-    return None
\ No newline at end of file
+    key = (spreadsheet_id, sheet_name)
+    if key not in tab_id_cache:
+        spreadsheet = service.spreadsheets().get(
+            spreadsheetId=spreadsheet_id,
+            fields='sheets.properties(sheetId,title)'
+        ).execute()
+        for sheet in spreadsheet['sheets']:
+            tab_id_cache[(spreadsheet_id, sheet['properties']['title'])] = sheet['properties']['sheetId']
+    return tab_id_cache.get(key)
\ No newline at end of file
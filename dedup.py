@@ -0,0 +1,243 @@
+import datetime
+import hashlib
+import logging
+import re
+import sqlite3
+from io import BytesIO
+
+DEDUP_DB = 'dedup_index.db'
+DEFAULT_POLICY = 'keep_latest'
+# what to do when another email reports a different count for a row we already have:
+#   keep_latest - overwrite the sheet's count with the new one
+#   keep_max    - keep whichever count is larger
+#   flag        - keep the existing count and record the conflict for a person to check
+POLICIES = ('keep_latest', 'keep_max', 'flag')
+
+logger = logging.getLogger('breadbot.dedup')
+
+
+def normalize_item(item):
+    return ' '.join(str(item).lower().split())
+
+
+# date is MM/DD/YYYY, matching how Sheet1 displays it
+def row_key(location, date, item):
+    return (location, date, normalize_item(item))
+
+
+def record_key(record):
+    return row_key(record.location, record.date_string, record.item)
+
+
+# exact content hash, plus a 16x16 difference hash so a re-sent photo that was
+# recompressed or resized by the mail client still matches. the perceptual hash
+# is scoped to the store, since two days' receipts from different stores can
+# look alike at that size
+def image_hashes(image_bytes, location):
+    hashes = ['sha256:' + hashlib.sha256(image_bytes).hexdigest()]
+    try:
+        from PIL import Image
+
+        with Image.open(BytesIO(image_bytes)) as image:
+            pixels = list(image.convert('L').resize((17, 16)).getdata())
+        bits = ''.join('1' if pixels[i] > pixels[i + 1] else '0'
+                       for i in range(len(pixels) - 1) if i % 17 != 16)
+        hashes.append(f'dhash:{location}:{int(bits, 2):064x}')
+    except Exception as e:
+        logger.debug("no perceptual hash for attachment: %s", e)
+    return hashes
+
+
+# local index of every row written to each spreadsheet, keyed on
+# (spreadsheet, location, date, normalized item), plus attachment hashes
+class DedupIndex:
+    def __init__(self, path=DEDUP_DB):
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS waste_rows (
+                sheet_id TEXT, location TEXT, date TEXT, item TEXT,
+                count INTEGER, email_id TEXT, sheet_row INTEGER,
+                PRIMARY KEY (sheet_id, location, date, item)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS attachments (
+                hash TEXT PRIMARY KEY, email_id TEXT
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS conflicts (
+                sheet_id TEXT, location TEXT, date TEXT, item TEXT,
+                kept_count INTEGER, new_count INTEGER, email_id TEXT, seen_at TEXT
+            );
+        ''')
+
+    def has_sheet(self, sheet_id):
+        return self.conn.execute(
+            'SELECT 1 FROM waste_rows WHERE sheet_id = ? LIMIT 1', (sheet_id,)
+        ).fetchone() is not None
+
+    # one-time load of rows that were written before the index existed
+    def seed(self, sheet_id, sheet_rows):
+        entries = []
+        for row_number, row in enumerate(sheet_rows, start=2):
+            if len(row) >= 4 and str(row[3]).isdigit():
+                location, date, item = row_key(row[1], row[0], row[2])
+                entries.append((sheet_id, location, date, item, int(row[3]), None, row_number))
+        with self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO waste_rows VALUES (?, ?, ?, ?, ?, ?, ?)', entries)
+        logger.info("seeded dedup index with %d rows", len(entries))
+
+    # True if any of the hashes was already seen in a different email
+    def seen_attachment(self, hashes, email_id):
+        for content_hash in hashes:
+            existing = self.conn.execute(
+                'SELECT email_id FROM attachments WHERE hash = ?', (content_hash,)
+            ).fetchone()
+            if existing and existing[0] != email_id:
+                return True
+        with self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO attachments VALUES (?, ?)',
+                                  [(content_hash, email_id) for content_hash in hashes])
+        return False
+
+    # returns (action, (old count, old email id)) for a new row under the given policy.
+    # action is 'append', 'skip', 'update' (correct the count of a row already in
+    # the sheet), 'replace' (the row from another email isn't written yet, so
+    # the buffered record is swapped for this one) or 'flag' (recorded as a conflict)
+    def resolve(self, sheet_id, key, count, email_id, policy):
+        existing = self.conn.execute(
+            'SELECT count, email_id, sheet_row FROM waste_rows WHERE sheet_id = ? AND location = ? AND date = ? AND item = ?',
+            (sheet_id, *key)
+        ).fetchone()
+
+        with self.conn:
+            if existing is None:
+                self.conn.execute('INSERT INTO waste_rows VALUES (?, ?, ?, ?, ?, ?, NULL)',
+                                  (sheet_id, *key, count, email_id))
+                return 'append', None
+
+            old_count, old_email_id, sheet_row = existing
+            previous = (old_count, old_email_id)
+            # the same receipt listing an item twice in one pass is not a duplicate, but
+            # an email re-read after its rows reached the sheet (its ProcessedEmails
+            # entry was never written) must not append them again
+            if old_email_id == email_id:
+                return ('append', None) if sheet_row is None else ('skip', previous)
+            if old_count == count:
+                return 'skip', previous
+
+            if policy == 'keep_latest' or (policy == 'keep_max' and count > old_count):
+                self.conn.execute(
+                    'UPDATE waste_rows SET count = ?, email_id = ? WHERE sheet_id = ? AND location = ? AND date = ? AND item = ?',
+                    (count, email_id, sheet_id, *key)
+                )
+                return ('update' if sheet_row is not None else 'replace'), previous
+
+        if policy == 'flag':
+            self.record_conflict(sheet_id, key, old_count, count, email_id)
+            return 'flag', previous
+        return 'skip', previous
+
+    def record_conflict(self, sheet_id, key, kept_count, new_count, email_id):
+        with self.conn:
+            self.conn.execute('INSERT INTO conflicts VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                              (sheet_id, *key, kept_count, new_count, email_id, datetime.datetime.now().isoformat()))
+        logger.warning("conflicting count for %s: keeping %s, email %s reported %d", key, kept_count, email_id, new_count)
+
+    # called once rows are appended; keys that already have a row keep the first one
+    def set_rows(self, sheet_id, keys, first_row):
+        with self.conn:
+            self.conn.executemany(
+                'UPDATE waste_rows SET sheet_row = ? WHERE sheet_id = ? AND location = ? AND date = ? AND item = ? AND sheet_row IS NULL',
+                [(first_row + offset, sheet_id, *key) for offset, key in enumerate(keys)]
+            )
+
+    # forgets what a failed email contributed, so its retry isn't mistaken for a duplicate
+    def discard_email(self, sheet_id, email_id):
+        with self.conn:
+            self.conn.execute('DELETE FROM waste_rows WHERE sheet_id = ? AND email_id = ? AND sheet_row IS NULL',
+                              (sheet_id, email_id))
+            self.conn.execute('DELETE FROM attachments WHERE email_id = ?', (email_id,))
+
+    # puts back the count and email a discarded email's update or replacement overwrote
+    def restore(self, sheet_id, key, count, email_id):
+        with self.conn:
+            self.conn.execute('''
+                INSERT INTO waste_rows VALUES (?, ?, ?, ?, ?, ?, NULL)
+                ON CONFLICT (sheet_id, location, date, item) DO UPDATE SET
+                    count = excluded.count, email_id = excluded.email_id
+            ''', (sheet_id, *key, count, email_id))
+
+    def sheet_row(self, sheet_id, key):
+        result = self.conn.execute(
+            'SELECT sheet_row FROM waste_rows WHERE sheet_id = ? AND location = ? AND date = ? AND item = ?',
+            (sheet_id, *key)
+        ).fetchone()
+        return result[0] if result else None
+
+
+# per-spreadsheet filter used while extracting rows: drops re-sent attachments,
+# drops duplicate rows, and queues count changes on the writer per the policy
+class Deduplicator:
+    def __init__(self, index, sheet_id, writer, policy=DEFAULT_POLICY):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown dedup policy: {policy}")
+        self.index = index
+        self.sheet_id = sheet_id
+        self.writer = writer
+        self.policy = policy
+        self.skipped_images = 0
+        self.skipped_rows = 0
+        self.pending = {}  # key -> record kept for appending, not yet known to be written
+        self.superseded = {}  # email id -> [(key, old count, old email id, replaced record)]
+
+    def is_duplicate_image(self, img_data):
+        if self.index.seen_attachment(image_hashes(img_data['stream'].getvalue(), img_data.get('location', 'Unknown')), img_data['email_id']):
+            self.skipped_images += 1
+            logger.info("skipping attachment %s from email %s, already processed from another email",
+                        img_data.get('filename'), img_data['email_id'])
+            return True
+        return False
+
+    # records must already have their location set
+    def filter_rows(self, img_data, records):
+        kept = []
+        for record in records:
+            key = record_key(record)
+            email_id = img_data['email_id']
+            action, previous = self.index.resolve(self.sheet_id, key, record.count, email_id, self.policy)
+            if action == 'replace':
+                replaced = self.pending.pop(key, None)
+                if replaced is not None:
+                    self.writer.drop(replaced)
+                self.superseded.setdefault(email_id, []).append((key, *previous, replaced))
+                action = 'append'
+
+            if action == 'append':
+                kept.append(record)
+                self.pending[key] = record
+            else:
+                self.skipped_rows += 1
+                if action == 'update':
+                    self.writer.update_count(key, record.count, email_id, previous[0])
+                    self.superseded.setdefault(email_id, []).append((key, *previous, None))
+                elif action == 'flag':
+                    self.writer.flag_conflict(key, previous[0], record.count, email_id)
+        return kept
+
+    # forgets what a failed email contributed: its index entries, the count
+    # corrections it queued, and any other email's rows or counts it displaced
+    def discard_email(self, email_id):
+        self.index.discard_email(self.sheet_id, email_id)
+        self.writer.drop_queued(email_id)
+        for key, old_count, old_email_id, replaced in reversed(self.superseded.pop(email_id, [])):
+            self.index.restore(self.sheet_id, key, old_count, old_email_id)
+            if replaced is not None:
+                self.writer.restore(replaced)
+                self.pending[key] = replaced
+            else:
+                # the older email's own correction may have been overwritten by this one's
+                self.writer.update_count(key, old_count, old_email_id)
+
+
+# parses the first row number out of an append response range like "Sheet1!A10:D25"
+def first_row_of(updated_range):
+    match = re.search(r'![A-Z]+(\d+)', updated_range or '')
+    return int(match.group(1)) if match else None
@@ -1,46 +1,38 @@
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
 from googleapiclient.errors import HttpError
-from googleapiclient.discovery import build
 import base64
-import os
-import pickle
 from io import BytesIO
 import logging
 from email import message_from_bytes 
+from email.utils import parsedate_to_datetime
 import time
+import tenants
+import token_store
 
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 MAX_DAILY_REQUESTS = 9000
 
-def get_gmail_service(client_secret_file):
-    creds = None
-    token_file = 'token.pickle'
-    
-    if os.path.exists(token_file):
-        with open(token_file, 'rb') as token:
-            creds = pickle.load(token)
-    
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            print("refreshing token")
-            creds.refresh(Request())
-        else:
-            print("getting new token")
-            flow = InstalledAppFlow.from_client_secrets_file(client_secret_file, SCOPES)
-            creds = flow.run_local_server(port=0)
-        
-        with open(token_file, 'wb') as token:
-            pickle.dump(creds, token)
-    
-    return build('gmail', 'v1', credentials=creds)
+# interactive=None signs in through the browser only when run from a terminal (see token_store)
+def get_gmail_service(client_secret_file, interactive=None):
+    from googleapiclient.discovery import build
+
+    creds = token_store.get_credentials(client_secret_file, SCOPES, interactive=interactive)
+    # use the discovery doc bundled with the client library instead of fetching it
+    return build('gmail', 'v1', credentials=creds, static_discovery=True)
 
 
 def search_messages(service, query):
+    messages, _ = search_messages_with_status(service, query)
+    return messages
+
+
+# same as search_messages, but also reports whether the listing finished
+# (False when a rate limit or error cut it short)
+def search_messages_with_status(service, query):
     try:
         messages = []
         next_page_token = None
         num_requests = 0
+        complete = False
         
         logging.info(f"searching for emails with query: {query}")
         
@@ -60,6 +52,7 @@ def search_messages(service, query):
                 
                 next_page_token = result.get('nextPageToken')
                 if not next_page_token:
+                    complete = True
                     break
                 time.sleep(0.1)
                     
@@ -72,13 +65,46 @@ def search_messages(service, query):
                     raise error
                     
         logging.info(f"found {len(messages)} total messages matching the query")
-        return messages
+        return messages, complete
         
     except Exception as e:
         logging.error(f"error in search_messages: {str(e)}")
-        return []
+        return [], False
     
-def get_images(service, msg_ids, gmail_service):
+# plain-text body and sent date (as an ordinal) of a parsed message, read once per email
+# so the typed-counts path doesn't have to decode the message again per image
+def message_text(email_message):
+    email_date = None
+    try:
+        email_date = parsedate_to_datetime(email_message['date']).toordinal()
+    except (TypeError, ValueError) as e:
+        logging.warning(f"unreadable email date {email_message['date']!r}: {e}")
+
+    for part in email_message.walk():
+        if part.get_content_type() == "text/plain":
+            payload = part.get_payload(decode=True)
+            if payload:
+                return payload.decode(part.get_content_charset() or 'utf-8', errors='replace'), email_date
+    return None, email_date
+
+
+# content type of a part worth reading: any image, or a PDF (some mail clients
+# send those as octet-stream). None for everything else
+def attachment_type(part):
+    content_type = part.get_content_type()
+    if part.get_content_maintype() == 'image' or content_type == 'application/pdf':
+        return content_type
+    if content_type == 'application/octet-stream' and (part.get_filename() or '').lower().endswith('.pdf'):
+        return 'application/pdf'
+    return None
+
+
+# one entry per image or PDF attachment, each carrying its email's text and date.
+# an email without any gets a single entry with no stream, so its typed counts are still read
+def get_images(service, msg_ids, gmail_service, sender_map=None):
+    if sender_map is None:
+        sender_map = tenants.get_sender_map()
+
     img_data_list = []
     batch_size = 5  
     
@@ -97,15 +123,7 @@ def get_images(service, msg_ids, gmail_service):
                 
                 from_header = next((header['value'] for header in msg_metadata['payload']['headers'] 
                                   if header['name'] == 'From'), '')
-                location = 'Unknown'
-                if 'location1@' in from_header.lower():
-                    location = 'location1'
-                elif 'location2@' in from_header.lower():
-                    location = 'location2'
-                elif 'location3@' in from_header.lower():
-                    location = 'location3'
-                elif 'location4@' in from_header.lower():
-                    location = 'location4'
+                chain, location = tenants.resolve_sender(from_header, sender_map) or (None, 'Unknown')
                 
                 logging.info(f"processing email from {location} with id: {msg_id}")
                 
@@ -117,20 +135,28 @@ def get_images(service, msg_ids, gmail_service):
                 
                 email_data = base64.urlsafe_b64decode(msg['raw'].encode('ASCII'))
                 email_message = message_from_bytes(email_data)
+                email_text, email_date = message_text(email_message)
                 
+                entry = {
+                    'stream': None,
+                    'filename': None,
+                    'content_id': None,
+                    'email_id': msg_id,
+                    'location': location,
+                    'chain': chain,
+                    'content_type': None,
+                    'email_text': email_text,
+                    'email_date': email_date
+                }
+                images = []
                 for part in email_message.walk():
-                    if part.get_content_maintype() == 'image':
+                    content_type = attachment_type(part)
+                    if content_type:
                         img_data = part.get_payload(decode=True)
                         if img_data:
-                            img_stream = BytesIO(img_data)
-                            img_data_list.append({
-                                'stream': img_stream,
-                                'filename': part.get_filename() or 'unknown',
-                                'content_id': part.get('Content-ID'),
-                                'email_id': msg_id,
-                                'location': location,
-                                'raw_content': msg['raw'] 
-                            })
+                            images.append(dict(entry, stream=BytesIO(img_data), filename=part.get_filename() or 'unknown',
+                                               content_id=part.get('Content-ID'), content_type=content_type))
+                img_data_list.extend(images or [entry])
                 
                 time.sleep(0.1) 
                 
@@ -140,5 +166,48 @@ def get_images(service, msg_ids, gmail_service):
         
         time.sleep(0.5)  
         
-    logging.info(f"processed {len(msg_ids)} emails, and found {len(img_data_list)} images")
-    return img_data_list
\ No newline at end of file
+    image_count = sum(1 for img_data in img_data_list if img_data['stream'] is not None)
+    logging.info(f"processed {len(msg_ids)} emails, and found {image_count} images")
+    return img_data_list
+
+def get_history_id(service):
+    profile = service.users().getProfile(userId='me').execute()
+    return profile['historyId']
+
+
+# returns ids of messages added since history_id, plus the history id to resume from.
+# raises HttpError 404 when history_id is too old and a full search is needed
+def list_new_message_ids(service, history_id):
+    msg_ids = []
+    next_page_token = None
+    latest_history_id = history_id
+
+    while True:
+        result = service.users().history().list(
+            userId='me',
+            startHistoryId=history_id,
+            historyTypes=['messageAdded'],
+            pageToken=next_page_token
+        ).execute()
+
+        for record in result.get('history', []):
+            for added in record.get('messagesAdded', []):
+                msg_ids.append(added['message']['id'])
+
+        latest_history_id = result.get('historyId', latest_history_id)
+        next_page_token = result.get('nextPageToken')
+        if not next_page_token:
+            break
+
+    return msg_ids, latest_history_id
+
+
+def get_sender(service, msg_id):
+    msg_metadata = service.users().messages().get(
+        userId='me',
+        id=msg_id,
+        format='metadata',
+        metadataHeaders=['From']
+    ).execute()
+    return next((header['value'] for header in msg_metadata['payload']['headers']
+                 if header['name'] == 'From'), '')
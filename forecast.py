@@ -0,0 +1,115 @@
+import datetime
+import json
+import logging
+import os
+import data_process
+import records
+
+ALPHA = 0.3  # weight of the newest day in each day-of-week baseline
+MIN_EXPECTED_WASTE = 1  # baselines below this don't get a recommendation
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+STATE_COLUMNS = ['store', 'item', 'weekday', 'baseline', 'last_date']
+
+
+# model state is one exponentially weighted baseline per (store, item, weekday),
+# plus the last date folded into it so re-sent rows aren't counted twice
+def load_state(path):
+    import pandas as pd
+
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            entries = json.load(f).get('entries', [])
+    else:
+        entries = []
+    return pd.DataFrame(entries, columns=STATE_COLUMNS).astype({'weekday': int, 'baseline': float})
+
+
+def save_state(state, path):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({'alpha': ALPHA, 'entries': state[STATE_COLUMNS].values.tolist()}, f)
+    os.replace(tmp_path, path)
+
+
+# folds new WasteRecords into the baselines. each new day is one vectorized
+# merge over the keys it touches, so a nightly update costs the size of that
+# day's rows, not the size of the history
+def update_state(state, waste_records):
+    import pandas as pd
+
+    if not waste_records:
+        return state
+    new = pd.DataFrame({
+        'date': [record.date - records.UNIX_EPOCH for record in waste_records],
+        'store': [record.location for record in waste_records],
+        'item': [record.item for record in waste_records],
+        'count': [record.count for record in waste_records]
+    })
+    new['date'] = pd.to_datetime(new['date'], unit='D')
+
+    daily = new.groupby(['date', 'store', 'item'], as_index=False)['count'].sum()
+    daily['weekday'] = daily['date'].dt.dayofweek
+    daily['date'] = daily['date'].dt.strftime('%Y-%m-%d')
+
+    keys = ['store', 'item', 'weekday']
+    for date, day_rows in daily.groupby('date', sort=True):
+        merged = day_rows.merge(state, on=keys, how='left')
+        fresh = merged['last_date'].isna() | (merged['last_date'] < date)
+        merged = merged[fresh]
+        if merged.empty:
+            continue
+
+        merged['baseline'] = (ALPHA * merged['count'] + (1 - ALPHA) * merged['baseline']).fillna(merged['count'])
+        merged['last_date'] = date
+        updated = merged[STATE_COLUMNS]
+
+        state = (pd.concat([state, updated])
+                 .drop_duplicates(subset=keys, keep='last')
+                 .reset_index(drop=True))
+
+    return state
+
+
+def recommendations(state, day):
+    weekday = day.weekday()
+    todays = state[(state['weekday'] == weekday) & (state['baseline'] >= MIN_EXPECTED_WASTE)]
+    todays = todays.sort_values(['store', 'baseline'], ascending=[True, False])
+
+    values = [
+        [f"Recommendations for {WEEKDAYS[weekday]} {day.strftime('%m/%d/%Y')}"],
+        ['Store', 'Menu Item', 'Expected Waste', 'Suggested Bake Reduction']
+    ]
+    values += [[store, item, round(baseline, 1), int(baseline)]
+               for store, item, baseline in todays[['store', 'item', 'baseline']].itertuples(index=False)]
+    return values
+
+
+def update_forecast(sheet_id, waste_records, state_file, credentials_file, day=None):
+    try:
+        import pandas  # noqa: F401
+    except ImportError:
+        logging.warning("pandas is not installed, skipping bake recommendations")
+        return
+
+    try:
+        state = update_state(load_state(state_file), waste_records)
+        save_state(state, state_file)
+
+        day = day or datetime.date.today() + datetime.timedelta(days=1)
+        values = recommendations(state, day)
+
+        service = data_process.get_sheets_service(credentials_file)
+        data_process.ensure_sheet_tab(service, sheet_id, 'Recommendations')
+        service.spreadsheets().values().clear(
+            spreadsheetId=sheet_id,
+            range='Recommendations!A:D'
+        ).execute()
+        service.spreadsheets().values().update(
+            spreadsheetId=sheet_id,
+            range='Recommendations!A1',
+            valueInputOption='RAW',
+            body={'values': values}
+        ).execute()
+        logging.info(f"wrote {len(values) - 2} bake recommendations for {day}")
+    except Exception as e:
+        logging.error(f"error updating bake recommendations: {e}", exc_info=True)
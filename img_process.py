@@ -1,311 +1,469 @@
-import pytesseract
-from PIL import Image
 import re
+import os
 import logging
 import datetime
+import log_config
+from collections import deque
+from records import WasteRecord
 
+ocr_logger = logging.getLogger('breadbot.ocr')
+parse_logger = logging.getLogger('breadbot.parse')
 
-def process_image_from_stream(image_stream, index):
-    try:
-        image = Image.open(image_stream)
-        logging.info(f"image {index} successfully opened. mode: {image.mode}")
-        
-        rotations = [0, 180]  
-        text = ''
-        for rotation in rotations:
-            try:
-                if rotation == 0:
-                    current_text = pytesseract.image_to_string(image, timeout=30)
-                else:
-                    rotated_image = image.rotate(rotation, expand=True)
-                    current_text = pytesseract.image_to_string(rotated_image, timeout=30)
-                    rotated_image.close()
-                    
-                logging.info(f"rotation {rotation} degrees text:\n{current_text}")
-                
-                if "Take Out" in current_text or "Ordered:" in current_text:
-                    text = current_text
-                    logging.info(f"found valid receipt text at {rotation} degrees rotation")
-                    break
-                    
-            except Exception as e:
-                logging.error(f"error processing rotation {rotation} for image {index}: {str(e)}")
-                if rotation != 0:
-                    try:
-                        rotated_image.close()
-                    except:
-                        pass
-
-        if not text:
-            logging.info(f"image {index} is invalid (no valid text found in any rotation)")
-            image.close()
-            return []
-            
-        parsed_data = parse_text(text)
-        if not parsed_data:
-            logging.warning(f"no data found from image {index}")
-        image.close()
-        return parsed_data
-    except Exception as e:
-        logging.error(f"error processing image {index}: {str(e)}", exc_info=True)
+
+LOW_CONFIDENCE = 80  # waste lines whose mean word confidence is below this get a second, line-level read
+LINE_PADDING = 6  # pixels kept around a line's box when it's cropped for re-OCR
+# one line per crop, limited to characters that appear on the receipts
+LINE_CONFIG = '--psm 7 -c tessedit_char_whitelist=ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789%&-/.'
+
+
+# runs tesseract once and groups its words back into lines, each with the
+# line text, the mean word confidence (0-100) and the line's bounding box
+def ocr_lines(image, config='', timeout=30):
+    import pytesseract
+
+    data = pytesseract.image_to_data(image, config=config, output_type=pytesseract.Output.DICT, timeout=timeout)
+    lines = {}
+    for i, word in enumerate(data['text']):
+        word = word.strip()
+        conf = float(data['conf'][i])
+        if not word or conf < 0:
+            continue
+
+        left, top = data['left'][i], data['top'][i]
+        right, bottom = left + data['width'][i], top + data['height'][i]
+        key = (data['block_num'][i], data['par_num'][i], data['line_num'][i])
+        line = lines.get(key)
+        if line is None:
+            lines[key] = {'words': [word], 'confs': [conf], 'box': [left, top, right, bottom]}
+        else:
+            line['words'].append(word)
+            line['confs'].append(conf)
+            box = line['box']
+            line['box'] = [min(box[0], left), min(box[1], top), max(box[2], right), max(box[3], bottom)]
+
+    return [{'text': ' '.join(line['words']),
+             'conf': sum(line['confs']) / len(line['confs']),
+             'box': line['box']}
+            for line in lines.values()]
+
+
+# re-reads only the low-confidence "N Wasted Item" lines from a tight crop of
+# the page, keeping the new reading when tesseract is more sure of it
+def reocr_low_confidence_lines(image, lines, index):
+    retried = improved = 0
+    for line in lines:
+        if line['conf'] >= LOW_CONFIDENCE or not WASTED_LINE_RE.search(line['text']):
+            continue
+
+        retried += 1
+        left, top, right, bottom = line['box']
+        crop = image.crop((max(left - LINE_PADDING, 0), max(top - LINE_PADDING, 0),
+                           min(right + LINE_PADDING, image.width), min(bottom + LINE_PADDING, image.height)))
         try:
-            image.close()
-        except:
-            pass
+            crop = crop.resize((crop.width * 2, crop.height * 2))
+            candidates = ocr_lines(crop, LINE_CONFIG)
+        except Exception as e:
+            ocr_logger.debug("line re-OCR failed for image %s: %s", index, e)
+            continue
+        finally:
+            crop.close()
+
+        if not candidates:
+            continue
+        text = ' '.join(candidate['text'] for candidate in candidates)
+        conf = sum(candidate['conf'] for candidate in candidates) / len(candidates)
+        if conf > line['conf'] and WASTED_LINE_RE.search(text):
+            ocr_logger.debug("image %s: re-read %r (%.0f) as %r (%.0f)", index, line['text'], line['conf'], text, conf)
+            line['text'], line['conf'] = text, conf
+            improved += 1
+
+    if retried:
+        ocr_logger.info("image %s: re-read %d low-confidence lines, %d improved", index, retried, improved)
+
+
+# pytesseract signals a timeout with a bare RuntimeError; its TesseractError for
+# ordinary failures subclasses RuntimeError, so the type has to match exactly
+def is_tesseract_timeout(error):
+    return type(error) is RuntimeError and 'timeout' in str(error).lower()
+
+
+# reads one page (an open PIL image, which the caller closes). timeout applies
+# to each full-page pass; ocr_scheduler sizes it to the image
+def process_image(image, index, catalog=None, timeout=30):
+    ocr_logger.debug("image %s successfully opened. mode: %s", index, image.mode)
+
+    rotations = [0, 180]  
+    page = None
+    lines = []
+    for rotation in rotations:
+        current_image = image if rotation == 0 else image.rotate(rotation, expand=True)
+        try:
+            current_lines = ocr_lines(current_image, timeout=timeout)
+            current_text = '\n'.join(line['text'] for line in current_lines)
+
+            ocr_logger.debug("rotation %d degrees text:\n%s", rotation, current_text)
+            log_config.sample_ocr_text(index, rotation, current_text)
+            
+            if "Take Out" in current_text or "Ordered:" in current_text:
+                page, lines = current_image, current_lines
+                ocr_logger.debug("found valid receipt text at %d degrees rotation", rotation)
+                break
+
+        except Exception as e:
+            # the other rotation would only time out too, and the caller should
+            # record the failure rather than call the image invalid
+            if is_tesseract_timeout(e):
+                if current_image is not image:
+                    current_image.close()
+                raise
+            ocr_logger.error("error processing rotation %d for image %s: %s", rotation, index, e)
+
+        if current_image is not image:
+            current_image.close()
+
+    if page is None:
+        ocr_logger.info("image %s is invalid (no valid text found in any rotation)", index)
         return []
+
+    reocr_low_confidence_lines(page, lines, index)
+    if page is not image:
+        page.close()
+
+    text = '\n'.join(line['text'] for line in lines)
+    parsed_data = parse_text(text, catalog=catalog, confidences=[round(line['conf'], 1) for line in lines])
+    if not parsed_data:
+        ocr_logger.warning("no data found from image %s", index)
+    return parsed_data
+
+
+OCR_WORKERS = min(4, os.cpu_count() or 1)  # pages of one document read at once; tesseract runs out of process
+PDF_DPI = 300  # tesseract's sweet spot for receipt-sized text
+
+
+# frames of a multi-page TIFF, copied one at a time as they're needed
+def tiff_frames(image):
+    from PIL import ImageSequence
+
+    for frame in ImageSequence.Iterator(image):
+        yield frame.copy()
+
+
+# pages of a PDF, each rasterized only when it's reached
+def pdf_pages(pdf_bytes):
+    from pdf2image import convert_from_bytes, pdfinfo_from_bytes
+
+    for number in range(1, pdfinfo_from_bytes(pdf_bytes)['Pages'] + 1):
+        yield convert_from_bytes(pdf_bytes, dpi=PDF_DPI, first_page=number, last_page=number)[0]
+
+
+def process_page(page, index, catalog, timeout):
+    try:
+        return process_image(page, index, catalog, timeout)
+    finally:
+        page.close()
+
+
+# reads a document's pages on a small thread pool, keeping only a few pages
+# decoded at a time, and returns their rows in page order. each page keeps the
+# date from its own receipt
+def process_pages(pages, index, catalog=None, timeout=30):
+    from concurrent.futures import ThreadPoolExecutor
+
+    rows = []
+    in_flight = deque()
+    page_count = 0
+    with ThreadPoolExecutor(max_workers=OCR_WORKERS) as pool:
+        for number, page in enumerate(pages, start=1):
+            page_count = number
+            if len(in_flight) >= OCR_WORKERS * 2:
+                rows.extend(in_flight.popleft().result())
+            in_flight.append(pool.submit(process_page, page, f"{index}.{number}", catalog, timeout))
+        while in_flight:
+            rows.extend(in_flight.popleft().result())
+
+    ocr_logger.info("document %s: %d rows from %d pages", index, len(rows), page_count)
+    return rows
+
+
+def process_image_from_stream(image_stream, index, catalog=None, timeout=30, content_type=None):
+    if content_type == 'application/pdf':
+        try:
+            import pdf2image  # noqa: F401
+        except ImportError:
+            ocr_logger.warning("pdf2image is not installed, skipping PDF attachment %s", index)
+            return []
+        return process_pages(pdf_pages(image_stream.getvalue()), index, catalog, timeout)
+
+    # PIL is only loaded once there's an image to read
+    from PIL import Image
+
+    # errors propagate; the caller records the failure against the image's email
+    with Image.open(image_stream) as image:
+        if getattr(image, 'n_frames', 1) > 1:
+            return process_pages(tiff_frames(image), index, catalog, timeout)
+        return process_image(image, index, catalog, timeout)
     
 
+# cleanup tables are compiled once at import rather than on every menu item
+CLEAN_PATTERNS = [
+    (r'\s*\$\s*\d+(?:[.,]\d{2})?', ''),  # Remove price artifacts
+    (r'\s*["\']+\s*', ''), # Remove quotes with surrounding spaces
+    (r'\s*[.,]*\s*00$', ''),  # Remove trailing "00"
+    (r'\s*[.,]*$', ''),  # Remove trailing punctuation
+    (r'\s*[-|]+\s*$', ''),  # Remove trailing dashes/bars
+    (r'[=»|?<>#¥©+—;:%\\!_,]+', ''),  # Remove special characters
+    (r'\s*\([^)]*\)', ''),  # Remove parentheses content
+    (r'\b[A-Za-z]+\s*[.,]\b', ''),  # Remove stray letters with punctuation
+    (r'\s*(?:slice|Slice)(?:\s|$)', ''),  # Remove "slice/Slice"
+    (r'\s*\b(?:Loaf|loaf)\b', ''),  # Remove "Loaf/loaf"
+    (r'\s*\[.*?\]', ''),  # Remove bracketed content
+    (r'\s*\b(?:Ww|Ly)\b', '100% WW'),  # Standardize WW
+    (r'\s+[A-Za-z]{1,2}$', ''),  # Remove trailing 1-2 letter suffixes
+    (r'\s*\b(?:Ta|Tw|Ao|Cai|Si|Bi|Mi|Nb|Os|Ee|In|Of|On|A|I|Q|B|J|N|O|R|S|U|W|X)\b', ''),  # Remove garbage tokens
+    (r'\s*\d+\s*(?:Oz|OZ|oz)?$', ''),  # Remove size indicators
+    (r'\s*[)}\\*]+$', ''),  # Remove trailing special chars
+    (r'\s*[\'"`]+', ''),  # Remove any remaining quotes
+    (r'\s*\b(?:Out|Res|Ee|Wee)\b\s*$', ''),  # Remove common trailing artifacts
+    (r'\s*\b(?:Jen|Cae|Le|Tw)\b', ''),  # Remove more garbage tokens
+    (r'\s{2,}', ' '),  # Normalize spaces
+    (r'(?<=\w)\]', ''),  # Remove ] when attached to word
+    (r'\s+$', ''),  # Remove trailing spaces
+]
+CLEAN_REGEXES = [(re.compile(pattern), replacement) for pattern, replacement in CLEAN_PATTERNS]
+
+
 # 3 steps to clean up menu_item 
 def clean_menu_item(item):
-    patterns = [
-        (r'\s*\$\s*\d+(?:[.,]\d{2})?', ''),  # Remove price artifacts
-        (r'\s*["\']+\s*', ''), # Remove quotes with surrounding spaces
-        (r'\s*[.,]*\s*00$', ''),  # Remove trailing "00"
-        (r'\s*[.,]*$', ''),  # Remove trailing punctuation
-        (r'\s*[-|]+\s*$', ''),  # Remove trailing dashes/bars
-        (r'[=»|?<>#¥©+—;:%\\!_,]+', ''),  # Remove special characters
-        (r'\s*\([^)]*\)', ''),  # Remove parentheses content
-        (r'\b[A-Za-z]+\s*[.,]\b', ''),  # Remove stray letters with punctuation
-        (r'\s*(?:slice|Slice)(?:\s|$)', ''),  # Remove "slice/Slice"
-        (r'\s*\b(?:Loaf|loaf)\b', ''),  # Remove "Loaf/loaf"
-        (r'\s*\[.*?\]', ''),  # Remove bracketed content
-        (r'\s*\b(?:Ww|Ly)\b', '100% WW'),  # Standardize WW
-        (r'\s+[A-Za-z]{1,2}$', ''),  # Remove trailing 1-2 letter suffixes
-        (r'\s*\b(?:Ta|Tw|Ao|Cai|Si|Bi|Mi|Nb|Os|Ee|In|Of|On|A|I|Q|B|J|N|O|R|S|U|W|X)\b', ''),  # Remove garbage tokens
-        (r'\s*\d+\s*(?:Oz|OZ|oz)?$', ''),  # Remove size indicators
-        (r'\s*[)}\\*]+$', ''),  # Remove trailing special chars
-        (r'\s*[\'"`]+', ''),  # Remove any remaining quotes
-        (r'\s*\b(?:Out|Res|Ee|Wee)\b\s*$', ''),  # Remove common trailing artifacts
-        (r'\s*\b(?:Jen|Cae|Le|Tw)\b', ''),  # Remove more garbage tokens
-        (r'\s{2,}', ' '),  # Normalize spaces
-        (r'(?<=\w)\]', ''),  # Remove ] when attached to word
-        (r'\s+$', ''),  # Remove trailing spaces
-    ]
-    
     cleaned = item.strip()
-    for pattern, replacement in patterns:
-        cleaned = re.sub(pattern, replacement, cleaned)
+    for pattern, replacement in CLEAN_REGEXES:
+        cleaned = pattern.sub(replacement, cleaned)
     
     return cleaned.strip()
 
-def standardize_menu_item(item):
-    standard_products = {
-        "Bluberry": "Blueberry",
-        "Seasonallseasonal": "Seasonal",
-        "Yegan": "Vegan",
-        "Whcc": "WWCC",
-        "Wncc": "WWCC",
-        "100 Ww": "100% WW",
-        "Ww100": "100% WW",
-        "Levain.00": "Levain",
-        "Croissantf": "Croissant",
-        "Chocolat": "Chocolate",
-        "Pumpernicke": "Pumpernickel",
-        "Veoa": "Vegan",
-        "PAC00": "PAC",
-        "Xl Ka": "XL",
-        "Xl": "XL",
-        "Crx": "Croissant",
-        "Bagu": "Baguette",
-        "Souffy": "Souffle",
-        "Quicheo": "Quiche",
-        "Quicheoe": "Quiche",
-        "Quicheae": "Quiche",
-        "Amond": "Almond",
-        "Buerr": "Beurre",
-        "Cheesecak": "Cheesecake",
-        "Aman": "Amann",
-        "Scon": "Scone",
-        "Muff": "Muffin",
-        "Cak": "Cake",
-        "Ro": "Roll",
-        "Ana": "Banana",
-        "Bi": "Banana",
-        "Hwcc": "WWCC",
-        "Slic": "Slice",
-        "Row": "Roll",
-        "Mbi": "MB",
-        "Pi": "Pie",
-        "Souff]e": "Souffle",
-        "Cook Le": "Cookie",
-        "Cook Cae": "Cookie",
-        "Veggie Quicheo": "Veggie Quiche",
-        "Coffee Cake Muff": "Coffee Cake Muffin",
-        "Jambon Buerr": "Jambon Beurre",
-        "Santa Cruz": "Santa Cruz Sandwich",
-        "Kouign Aman": "Kouign Amann",
-        "Olive Ciabatta Ee": "Olive Ciabatta",
-        "Olive Ciabatta Bread": "Olive Ciabatta",
-        "WWCC Cookie Cae": "WWCC Cookie",
-        "Blueberry Co": "Blueberry Coffee Cake Muffin",
-        "Seasona Polenta": "Seasonal Polenta Cake",
-    }
-
-    patterns = [
-        (r'\b(?:Vegan|Pumpkin|Almond)\s+Chocola?t?e?\s+Banana\s+Muff(?:in)?', 'Vegan Chocolate Banana Muffin'),
-        (r'(?:Seasonal)?\s*Polenta\s*Cake?', 'Seasonal Polenta Cake'),
-        (r'\b(?:Ham & Cheese Roll?|Rol)\b', 'Ham & Cheese Roll'),
-        (r'\b(?:MB|Mb|MB X|MB\'i)\b', 'MB'),
-        (r'\s*\(?GF\)?', '(GF)'),
-        (r'\bNultigrain\b', 'Multigrain'),
-        (r'\bCo\s+(?=Cake|Coffee)\b', 'Coffee'),
-        (r'Chocolate\s+(?:Bi|Ana)\s+(?:Muff|Muffin)', 'Chocolate Banana Muffin'),
-        (r'(?:Mini\s+)?Mango\s+Lassi\s+Cheesecak[e]?', 'Mango Lassi Cheesecake'),
-        (r'Coconut\s+Cream\s+Pi[e]?', 'Coconut Cream Pie'),
-        (r'Blueberry\s+(?:Co|Coffee)\s+(?:Cake\s+)?(?:Muff|Muffin)(?:in)?', 'Blueberry Coffee Cake Muffin'),
-        (r'(?:Chocolate\s+)?Almond\s+(?:Crx|Croissant)', 'Almond Croissant'),
-        (r'Santa Cruz Sandwich (?:Vegan|Sandwich)', 'Santa Cruz Sandwich'),
-        (r'(?:% Ww%|% WW \$)', '100% WW'),
-    ]
 
+STANDARD_PRODUCTS = {
+    "Bluberry": "Blueberry",
+    "Seasonallseasonal": "Seasonal",
+    "Yegan": "Vegan",
+    "Whcc": "WWCC",
+    "Wncc": "WWCC",
+    "100 Ww": "100% WW",
+    "Ww100": "100% WW",
+    "Levain.00": "Levain",
+    "Croissantf": "Croissant",
+    "Chocolat": "Chocolate",
+    "Pumpernicke": "Pumpernickel",
+    "Veoa": "Vegan",
+    "PAC00": "PAC",
+    "Xl Ka": "XL",
+    "Xl": "XL",
+    "Crx": "Croissant",
+    "Bagu": "Baguette",
+    "Souffy": "Souffle",
+    "Quicheo": "Quiche",
+    "Quicheoe": "Quiche",
+    "Quicheae": "Quiche",
+    "Amond": "Almond",
+    "Buerr": "Beurre",
+    "Cheesecak": "Cheesecake",
+    "Aman": "Amann",
+    "Scon": "Scone",
+    "Muff": "Muffin",
+    "Cak": "Cake",
+    "Ro": "Roll",
+    "Ana": "Banana",
+    "Bi": "Banana",
+    "Hwcc": "WWCC",
+    "Slic": "Slice",
+    "Row": "Roll",
+    "Mbi": "MB",
+    "Pi": "Pie",
+    "Souff]e": "Souffle",
+    "Cook Le": "Cookie",
+    "Cook Cae": "Cookie",
+    "Veggie Quicheo": "Veggie Quiche",
+    "Coffee Cake Muff": "Coffee Cake Muffin",
+    "Jambon Buerr": "Jambon Beurre",
+    "Santa Cruz": "Santa Cruz Sandwich",
+    "Kouign Aman": "Kouign Amann",
+    "Olive Ciabatta Ee": "Olive Ciabatta",
+    "Olive Ciabatta Bread": "Olive Ciabatta",
+    "WWCC Cookie Cae": "WWCC Cookie",
+    "Blueberry Co": "Blueberry Coffee Cake Muffin",
+    "Seasona Polenta": "Seasonal Polenta Cake",
+}
+STANDARD_PRODUCT_REGEXES = [(re.compile(rf'\b{old}\b', re.IGNORECASE), new) for old, new in STANDARD_PRODUCTS.items()]
+
+STANDARD_PATTERNS = [
+    (r'\b(?:Vegan|Pumpkin|Almond)\s+Chocola?t?e?\s+Banana\s+Muff(?:in)?', 'Vegan Chocolate Banana Muffin'),
+    (r'(?:Seasonal)?\s*Polenta\s*Cake?', 'Seasonal Polenta Cake'),
+    (r'\b(?:Ham & Cheese Roll?|Rol)\b', 'Ham & Cheese Roll'),
+    (r'\b(?:MB|Mb|MB X|MB\'i)\b', 'MB'),
+    (r'\s*\(?GF\)?', '(GF)'),
+    (r'\bNultigrain\b', 'Multigrain'),
+    (r'\bCo\s+(?=Cake|Coffee)\b', 'Coffee'),
+    (r'Chocolate\s+(?:Bi|Ana)\s+(?:Muff|Muffin)', 'Chocolate Banana Muffin'),
+    (r'(?:Mini\s+)?Mango\s+Lassi\s+Cheesecak[e]?', 'Mango Lassi Cheesecake'),
+    (r'Coconut\s+Cream\s+Pi[e]?', 'Coconut Cream Pie'),
+    (r'Blueberry\s+(?:Co|Coffee)\s+(?:Cake\s+)?(?:Muff|Muffin)(?:in)?', 'Blueberry Coffee Cake Muffin'),
+    (r'(?:Chocolate\s+)?Almond\s+(?:Crx|Croissant)', 'Almond Croissant'),
+    (r'Santa Cruz Sandwich (?:Vegan|Sandwich)', 'Santa Cruz Sandwich'),
+    (r'(?:% Ww%|% WW \$)', '100% WW'),
+]
+STANDARD_REGEXES = [(re.compile(pattern), replacement) for pattern, replacement in STANDARD_PATTERNS]
+
+ABBREVIATIONS = {'MB', 'PAC', 'WWCC', 'GF', 'WW', 'XL'}
+
+
+# catalog is an optional per-chain {"ocr misread": "menu name"} map applied before the built-in one
+def standardize_menu_item(item, catalog=None):
     cleaned = item.strip()
-    for old, new in standard_products.items():
-        cleaned = re.sub(rf'\b{old}\b', new, cleaned, flags=re.IGNORECASE)
+    for old, new in (catalog or {}).items():
+        cleaned = re.sub(rf'\b{re.escape(old)}\b', new, cleaned, flags=re.IGNORECASE)
 
-    for pattern, replacement in patterns:
-        cleaned = re.sub(pattern, replacement, cleaned)
+    for pattern, new in STANDARD_PRODUCT_REGEXES:
+        cleaned = pattern.sub(new, cleaned)
+
+    for pattern, replacement in STANDARD_REGEXES:
+        cleaned = pattern.sub(replacement, cleaned)
 
     words = cleaned.split()
-    abbrev = {'MB', 'PAC', 'WWCC', 'GF', 'WW', 'XL'}
-    words = [w.upper() if w.upper() in abbrev else w.capitalize() for w in words]
+    words = [w.upper() if w.upper() in ABBREVIATIONS else w.capitalize() for w in words]
     return ' '.join(words)
 
-def post_standardize_clean(item):
-    patterns = [
-        (r'\s*[-|:;,]+$', ''),  #  trailing punctuation
-        (r'\s*[0-9]+$', ''),  #  trailing numbers
-        (r'\s*\.+$', ''),  #  trailing dots
-        (r'\s*\b(?:In|Of|On|A|I|Q)\b$', ''),  #  trailing words
-        (r'\b[0-9]+\b', ''),  #  standalone numbers
-        (r'\s{2,}', ' '),  # extra spaces
-        (r'^\s*[&]\s*', ''),  #  leading &
-        (r'(?<=\S)\s*&\s*$', ''),  #  trailing &
-        (r'\s+$', ''),  #  trailing spaces
-        (r'\s*(?:\'|\")\s*$', ''),  #  trailing quotes
-        (r'(?<=\w)\s*\$\s*$', ''),  #  trailing dollar signs
-        (r'\s+(?:f|i)$', ''),  #  trailing f or i
-    ]
 
+POST_CLEAN_PATTERNS = [
+    (r'\s*[-|:;,]+$', ''),  #  trailing punctuation
+    (r'\s*[0-9]+$', ''),  #  trailing numbers
+    (r'\s*\.+$', ''),  #  trailing dots
+    (r'\s*\b(?:In|Of|On|A|I|Q)\b$', ''),  #  trailing words
+    (r'\b[0-9]+\b', ''),  #  standalone numbers
+    (r'\s{2,}', ' '),  # extra spaces
+    (r'^\s*[&]\s*', ''),  #  leading &
+    (r'(?<=\S)\s*&\s*$', ''),  #  trailing &
+    (r'\s+$', ''),  #  trailing spaces
+    (r'\s*(?:\'|\")\s*$', ''),  #  trailing quotes
+    (r'(?<=\w)\s*\$\s*$', ''),  #  trailing dollar signs
+    (r'\s+(?:f|i)$', ''),  #  trailing f or i
+]
+POST_CLEAN_REGEXES = [(re.compile(pattern), replacement) for pattern, replacement in POST_CLEAN_PATTERNS]
+HAS_WORD_RE = re.compile(r'[A-Za-z]{2,}')
+
+
+def post_standardize_clean(item):
     cleaned = item.strip()
-    for pattern, replacement in patterns:
-        cleaned = re.sub(pattern, replacement, cleaned)
+    for pattern, replacement in POST_CLEAN_REGEXES:
+        cleaned = pattern.sub(replacement, cleaned)
 
-    if len(cleaned) <= 1 or not re.search(r'[A-Za-z]{2,}', cleaned):
+    if len(cleaned) <= 1 or not HAS_WORD_RE.search(cleaned):
         return ''
 
     return cleaned.strip()
 
+
 def is_waste_section_header(line):
     """Check for waste section header in various formats"""
-    cleaned_line = re.sub(r'[*_#]', '', line.strip())
-    logging.info(f"is_waste check -- after cleaning markdown: '{cleaned_line}'")
-    
-    waste_patterns = [
-        (r'^WASTE:?$'),
-        (r'^WASTE REPORT:?$'),
-        (r'^WASTED:?$'),
-        (r'^WASTE ITEMS:?$')
-    ]
+    cleaned_line = MARKDOWN_RE.sub('', line.strip())
+    return WASTE_HEADER_RE.match(cleaned_line) is not None
+
+
+# line classifiers for parse_text, compiled once
+MARKDOWN_RE = re.compile(r'[*_#]')
+WASTE_HEADER_RE = re.compile(r'^(?:WASTE|WASTE REPORT|WASTED|WASTE ITEMS):?$', re.IGNORECASE)
+ORDERED_DATE_RE = re.compile(r'(\d{1,2}/\d{1,2}/\d{2}\s+\d{1,2}:\d{2}\s+[APM]{2})')
+WASTED_LINE_RE = re.compile(r"(\d+)\s+Wasted\s+(.+)")
+WHITESPACE_RE = re.compile(r'\s+')
+
+
+# date ordinal from a receipt's "Ordered: 01/02/24 9:15 PM" line; None if it's there but unreadable
+def parse_receipt_date(raw_date):
+    try:
+        parsed_date = datetime.datetime.strptime(raw_date, "%m/%d/%y %I:%M %p")
+        return parsed_date.toordinal()
+    except ValueError:
+        try:
+            cleaned_date = WHITESPACE_RE.sub(' ', raw_date).strip()
+            parsed_date = datetime.datetime.strptime(cleaned_date, "%m/%d/%Y %I:%M %p")
+            return parsed_date.toordinal()
+        except ValueError:
+            return None
+
 
-    return any(re.match(pattern, cleaned_line, re.IGNORECASE) for pattern in waste_patterns)
+def normalize_menu_item(item, catalog=None):
+    cleaned_menu_item = clean_menu_item(item)
+    stdz_menu_item = standardize_menu_item(cleaned_menu_item, catalog)
+    final_menu_item = post_standardize_clean(stdz_menu_item)
 
+    if len(final_menu_item) <= 1 or final_menu_item in ['', ' ']:
+        return None
+    return final_menu_item
 
-def parse_text(text, email_date=None):
-    lines = text.split('\n')
+
+# one pass over the lines handles both formats: receipt text ("Ordered:" date
+# + "N Wasted Item" lines) and typed email bodies (a "WASTE:" header followed
+# by "Item: N" lines). email items are only cleaned up if the text turns out
+# not to be a receipt, which is when the email format is used.
+# returns WasteRecords without a location; email_date is a date ordinal.
+# confidences, when given, holds the OCR confidence of each line of text and
+# is set on the receipt record read from that line
+def parse_text(text, email_date=None, catalog=None, confidences=None):
     data = []
     date = None
+    email_items = []
+    in_waste_section = False
+    waste_section_found = False  # check if waste section text of email body is reached
 
-    for idx, line in enumerate(lines):
+    for line_number, line in enumerate(text.split('\n')):
         if "Ordered:" in line:
-            date_match = re.search(r'(\d{1,2}/\d{1,2}/\d{2}\s+\d{1,2}:\d{2}\s+[APM]{2})', line)
+            date_match = ORDERED_DATE_RE.search(line)
             if date_match:
-                raw_date = date_match.group(1)
-                try:
-                    parsed_date = datetime.datetime.strptime(raw_date, "%m/%d/%y %I:%M %p")
-                    date = parsed_date.strftime("%m/%d/%Y")
-                except ValueError:
-                    try:
-                        cleaned_date = re.sub(r'\s+', ' ', raw_date).strip()
-                        parsed_date = datetime.datetime.strptime(cleaned_date, "%m/%d/%Y %I:%M %p")
-                        date = parsed_date.strftime("%m/%d/%Y")
-                    except ValueError:
-                        date = None
-        
+                date = parse_receipt_date(date_match.group(1))
+
         # if we find date, find image's waste data 
-        match = re.search(r"(\d+)\s+Wasted\s+(.+)", line)
+        match = WASTED_LINE_RE.search(line)
         if match and date:
-            waste_count = int(match.group(1).strip())
-            menu_item = match.group(2).strip()
-            
-            
-            cleaned_menu_item = clean_menu_item(menu_item)
-            stdz_menu_item = standardize_menu_item(cleaned_menu_item)
-            final_menu_item = post_standardize_clean(stdz_menu_item)
-            
-            if len(final_menu_item) <= 1 or final_menu_item in ['', ' ']:
-                continue
-            
-            data.append([date, final_menu_item, waste_count])
-    
+            menu_item = normalize_menu_item(match.group(2).strip(), catalog)
+            if menu_item:
+                data.append(WasteRecord(date, menu_item, int(match.group(1).strip()),
+                                        confidence=confidences[line_number] if confidences else None))
+
+        line = line.strip()
+        if not line:
+            continue
+
+        if is_waste_section_header(line):
+            in_waste_section = True
+            waste_section_found = True
+            continue
+
+        if in_waste_section and ':' in line:
+            item, count = line.split(':', 1)
+            count = count.strip()
+            if count.isdigit():
+                email_items.append((item.strip(), int(count)))
+
+    if data:
+        return data
+
     # check email text if no image data found
-    if not data:
-        logging.info("No image data found, checking email text format")
-        if not date:
-            date = email_date
-            logging.info(f"Using email date: {date}")
-        
-        if not date:
-            logging.warning("No date available (neither from image nor email)")
-            return []
+    parse_logger.debug("No image data found, checking email text format")
+    if not date:
+        date = email_date
+        parse_logger.debug("Using email date: %s", date)
+
+    if not date:
+        parse_logger.warning("No date available (neither from image nor email)")
+        return []
+
+    for item, waste_count in email_items:
+        menu_item = normalize_menu_item(item, catalog)
+        if menu_item:
+            data.append(WasteRecord(date, menu_item, waste_count))
+
+    # most emails are photos with no typed counts, so this is the usual outcome
+    if not waste_section_found:
+        parse_logger.debug("no waste section found in email text")
+    elif not data:
+        parse_logger.warning("waste section found but no valid waste data extracted")
 
-        if date:  
-            logging.info(f"Processing email text with date: {date}")
-            in_waste_section = False
-            waste_section_found = False  # check if waste section text of email body is reached
-            
-            for line in lines:
-                line = line.strip()
-                if not line:
-                    continue
-                
-                if is_waste_section_header(line):
-                    logging.info(f"found waste section header in line: {line}")
-                    in_waste_section = True
-                    waste_section_found = True
-                    continue
-                
-                if in_waste_section:
-                    logging.info(f"processing line in waste section: {line}")
-                    if ':' in line:
-                        item, count = line.split(':', 1)
-                        item = item.strip()
-                        count = count.strip()
-                        logging.info(f"split into item: '{item}' and count: '{count}'")
-
-                        if count.isdigit():
-                            waste_count = int(count)
-                            logging.info(f"found valid waste count: {waste_count}")
-                            cleaned_menu_item = clean_menu_item(item)
-                            logging.info(f"after clean_menu_item: '{cleaned_menu_item}'")
-                            stdz_menu_item = standardize_menu_item(cleaned_menu_item)
-                            logging.info(f"after standardize_menu_item: '{stdz_menu_item}'")
-                            final_menu_item = post_standardize_clean(stdz_menu_item)
-                            logging.info(f"after post_standardize_clean: '{final_menu_item}'")
-
-                            if len(final_menu_item) <= 1 or final_menu_item in ['', ' ']:
-                                logging.info(f"skipping invalid menu item: '{final_menu_item}'")
-                                continue
-                            
-                            data.append([date, final_menu_item, waste_count])
-                            logging.info(f"added waste data: {[date, final_menu_item, waste_count]}")
-                        else:
-                            logging.info(f"skipping line - count isn't a digit: '{count}'")
-                    else:
-                        logging.info(f"skipping line - no colon found: '{line}'")
-
-            if not waste_section_found:
-                logging.warning("no waste section found in email text")
-            elif not data:
-                logging.warning("waste section found but no valid waste data extracted")
-    
     return data
@@ -0,0 +1,101 @@
+import datetime
+import gzip
+import json
+import logging
+import os
+import random
+import threading
+
+# logging is configured from the environment so cron lines can turn diagnostics on per run:
+#   BREADBOT_LOG_FORMAT=json                            one JSON object per line instead of plain text
+#   BREADBOT_LOG_LEVELS=breadbot.ocr=DEBUG,breadbot.parse=WARNING    per-subsystem levels
+#   BREADBOT_OCR_SAMPLE_RATE=0.1                        fraction of raw OCR texts saved to a gzip file
+# subsystem loggers: breadbot.ocr, breadbot.parse, breadbot.pipeline, breadbot.dedup
+LOG_FORMAT_ENV = 'BREADBOT_LOG_FORMAT'
+LOG_LEVELS_ENV = 'BREADBOT_LOG_LEVELS'
+OCR_SAMPLE_RATE_ENV = 'BREADBOT_OCR_SAMPLE_RATE'
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def make_formatter():
+    if os.environ.get(LOG_FORMAT_ENV, '').lower() == 'json':
+        return JsonFormatter()
+    return logging.Formatter(TEXT_FORMAT)
+
+
+# "breadbot.ocr=DEBUG,breadbot.parse=WARNING" -> sets each logger's level
+def apply_levels(spec):
+    for entry in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, level = entry.partition('=')
+        if not level:
+            logging.warning(f"ignoring log level setting without '=': {entry}")
+            continue
+        try:
+            logging.getLogger(name.strip()).setLevel(level.strip().upper())
+        except ValueError:
+            logging.warning(f"ignoring unknown log level in setting: {entry}")
+
+
+# writes a random sample of raw OCR text to logs/ocr_samples_<date>.jsonl.gz,
+# keeping multi-kilobyte OCR dumps out of the main log file
+class OcrTextSampler:
+    def __init__(self, log_dir, rate):
+        self.rate = rate
+        self.path = os.path.join(log_dir, f'ocr_samples_{datetime.datetime.now().strftime("%Y%m%d")}.jsonl.gz')
+        self.lock = threading.Lock()
+
+    def maybe_write(self, index, rotation, text):
+        if self.rate <= 0 or random.random() >= self.rate:
+            return
+        line = json.dumps({
+            'time': datetime.datetime.now().isoformat(),
+            'image': index,
+            'rotation': rotation,
+            'text': text
+        })
+        # each write appends a complete gzip member, so the file stays readable with zcat
+        with self.lock, gzip.open(self.path, 'at', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+
+ocr_sampler = None
+
+
+def configure_ocr_sampling(log_dir):
+    global ocr_sampler
+    try:
+        rate = float(os.environ.get(OCR_SAMPLE_RATE_ENV, '0'))
+    except ValueError:
+        logging.warning(f"ignoring invalid {OCR_SAMPLE_RATE_ENV}")
+        rate = 0
+    ocr_sampler = OcrTextSampler(log_dir, rate) if rate > 0 else None
+
+
+def sample_ocr_text(index, rotation, text):
+    if ocr_sampler is not None:
+        ocr_sampler.maybe_write(index, rotation, text)
+
+
+def configure(log_file, log_dir):
+    formatter = make_formatter()
+    handlers = [logging.FileHandler(log_file), logging.StreamHandler()]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    logging.basicConfig(level=logging.INFO, handlers=handlers)
+    apply_levels(os.environ.get(LOG_LEVELS_ENV, ''))
+    configure_ocr_sampling(log_dir)
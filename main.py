@@ -1,168 +1,322 @@
 import email_access
 import img_process 
 import data_process
-import email.utils
+import run_state
+import tenants
+import log_config
+import forecast
+import dedup
+import message_status
+import ocr_scheduler
+import profiling
+import argparse
 import os
 import logging 
-import base64
 import datetime
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
+import time
 from io import BytesIO
-from email import message_from_bytes
 
 SERVICE_ACCOUNT_FILE = '/your_path'
 CLIENT_SECRET_FILE = '/your_path'
 YOUR_EMAIL = 'your_email@gmail.com'  
+BATCH_SIZE = 25  # emails per commit; batches from different chains take turns
+
+logger = logging.getLogger('breadbot.pipeline')
 
 def setup_logging():
     log_dir = '/Users/yih/Desktop/bread-bot/logs/'
     os.makedirs(log_dir, exist_ok=True)
     log_file = os.path.join(log_dir, f'bread-bot_{datetime.datetime.now().strftime("%Y%m%d")}.txt')
     
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler(log_file),
-            logging.StreamHandler()
-        ]
-    )
+    log_config.configure(log_file, log_dir)
     logging.info(f"\n--- script started at {datetime.datetime.now()} ---")
+    profiling.enable_from_env(log_dir)
 
 
-def main():
-    setup_logging()
-    
-    email_senders = [
-        'location1@company.com', 
-        'location2@company.com',
-        'location3@company.com',
-        'location4@company.com'
-    ]
+# typed counts in the email body are cheap to parse, so each email's body is read
+# first and its images are only OCR'd when the body has no waste rows
+def parse_email_text(img_data, catalog=None):
+    email_text = img_data.get('email_text')
+    if not email_text:
+        return []
+    try:
+        return img_process.parse_text(email_text, img_data.get('email_date'), catalog)
+    except Exception as e:
+        logger.error("error processing email text for email %s: %s", img_data.get('email_id'), e, exc_info=True)
+        return []
 
-    query = ' OR '.join(f'from:{sender}' for sender in email_senders)
 
-    try:
-        logging.info("authenticating gmail...")
-        gmail_service = email_access.get_gmail_service(CLIENT_SECRET_FILE)
+# files parsed records under the image's store and drops any the dedup index already has
+def record_rows(outcome, img_data, res_data, deduplicator=None):
+    outcome['handled'] = True
+    location = img_data.get('location', 'Unknown')
+    for record in res_data:
+        record.set_location(location)
 
-        logging.info("checking emails...")
-        emails = email_access.search_messages(gmail_service, query)
-        if not emails:
-            logging.warning("no emails found")
+    if deduplicator:
+        res_data = deduplicator.filter_rows(img_data, res_data)
+        if not res_data:
+            logger.info("all rows from email %s were already recorded", img_data.get('email_id'))
             return
 
-        # Get or create spreadsheet once
-        sheet_id = data_process.get_or_create_spreadsheet('MB Inventory Sheet', SERVICE_ACCOUNT_FILE)
-        if not sheet_id:
-            logging.error("failed to get or create spreadsheet")
-            return
+    logger.debug("adding %d rows for location %s: %s", len(res_data), location, res_data)
+    outcome['rows'].extend(res_data)
 
 
-        processed_emails = data_process.get_processed_emails(sheet_id, SERVICE_ACCOUNT_FILE)
-        new_emails = [email for email in emails if email['id'] not in processed_emails]
+# returns WasteRecords, only for emails whose images all went through. an email
+# with an image that errored is marked failed in statuses (and its dedup entries
+# dropped) so retry.py can try it again. one that was read cleanly but had no
+# waste rows (a note, a logo, a skipped PDF) is marked no_data, not retried
+def extract_rows(img_attachments, catalog=None, deduplicator=None, statuses=None):
+    logger.info("processing %d emails...", len({img_data.get('email_id') for img_data in img_attachments}))
+    new_data = []
+    # seeded in arrival order, so rows come out in that order whatever order OCR runs in
+    emails = {img_data.get('email_id'): {'rows': [], 'handled': False, 'error': None, 'read': 0, 'duplicates': 0}
+              for img_data in img_attachments}
 
-        if not new_emails:
-            logging.info("no new emails to process")
-            data_process.create_analytics_sheet(sheet_id, SERVICE_ACCOUNT_FILE)
-            return
+    first_images = {}
+    for img_data in img_attachments:
+        first_images.setdefault(img_data.get('email_id'), img_data)
+    for email_id, img_data in first_images.items():
+        res_data = parse_email_text(img_data, catalog)
+        logger.debug("email text processing result for email %s: %s", email_id, res_data)
+        if res_data:
+            record_rows(emails[email_id], img_data, res_data, deduplicator)
 
-        logging.info(f"found {len(new_emails)} new emails to process")
+    images = [img_data for img_data in img_attachments if img_data.get('stream') is not None]
+    to_ocr = [img_data for img_data in images if not emails[img_data.get('email_id')]['handled']]
+    if len(to_ocr) < len(images):
+        logger.info("%d images skipped, their emails had typed waste counts", len(images) - len(to_ocr))
 
-        """ #force processing
-        new_emails = emails  
-        logging.info(f"Processing {len(new_emails)} emails")
-        """
+    for idx, img_data, lane, timeout in ocr_scheduler.schedule(to_ocr):
+        logger.debug("processing image %d of %d (%s lane, timeout %.0fs)", idx, len(to_ocr), lane, timeout)
+        outcome = emails[img_data.get('email_id')]
+        try:
+            if 'stream' not in img_data or not isinstance(img_data['stream'], BytesIO):
+                logger.error("invalid image data for image %d", idx)
+                outcome['error'] = "invalid image data"
+                continue
 
-        logging.info("getting image attachments...")
-        img_attachments = email_access.get_images(gmail_service, [msg['id'] for msg in new_emails], gmail_service)
-        if not img_attachments:
-            logging.warning("no image attachments found")
-            return
+            # pre-filtered images are never OCR'd, or hashed, so a signature logo
+            # shared by every email isn't taken for a re-sent receipt
+            if lane == ocr_scheduler.SKIP:
+                continue
 
-        logging.info(f"processing {len(img_attachments)} image attachments...")
-        new_data = [["date", "location", "menu item", "waste count"]]  
+            outcome['read'] += 1
+            if deduplicator and deduplicator.is_duplicate_image(img_data):
+                outcome['duplicates'] += 1
+                continue
 
-        for idx, img_data in enumerate(img_attachments, start=1):
-            logging.info(f"processing image {idx} of {len(img_attachments)}")
+            img_stream = img_data['stream']
+            img_stream.seek(0)
             try:
-                if 'stream' not in img_data or not isinstance(img_data['stream'], BytesIO):
-                    logging.error(f"invalid image data for image {idx}")
-                    continue
-
-                # Try image processing first
-                img_stream = img_data['stream']
-                img_stream.seek(0)
-                res_data = img_process.process_image_from_stream(img_stream, idx)
-                logging.info(f"image processing result for image {idx}: {res_data}")
-
-                # If no image data, try email text
-                if not res_data:
-                    try:
-                        logging.info("no image data found. processing email text:")
-                        email_data = base64.urlsafe_b64decode(img_data['raw_content'].encode('ASCII'))
-                        email_message = message_from_bytes(email_data)
-                        
-                        msg_date = email.utils.parsedate_to_datetime(email_message['date'])
-                        email_date = msg_date.strftime("%m/%d/%Y")
-
-                        # Handle multipart messages
-                        email_text = None
-                        if email_message.is_multipart():
-                            logging.info("Processing multipart email")
-                            for part in email_message.walk():
-                                if part.get_content_type() == "text/plain":
-                                    email_text = part.get_payload(decode=True).decode('utf-8')
-                                    logging.info("found text content")
-                                    break
-                        else:
-                            email_text = email_message.get_payload(decode=True).decode('utf-8')
-                            logging.info("found single part email content")
-
-                        if email_text:
-                            res_data = img_process.parse_text(email_text, email_date)
-                            logging.info(f"email text processing result: {res_data}")
-                        else:
-                            logging.warning("no text content found in email")
-
-                    except Exception as e:
-                        logging.error(f"error processing email text: {str(e)}", exc_info=True)
-                        continue
-
-                if res_data:  
-                    location = img_data.get('location', 'Unknown')
-                    logging.info(f"adding data for location: {location}")
-                    for row in res_data:
-                        new_data.append([row[0], location] + row[1:])
-                        logging.info(f"added row: {[row[0], location] + row[1:]}")
-                else: 
-                    logging.warning(f"no data extracted from image {idx} or its email")
-
+                res_data = img_process.process_image_from_stream(img_stream, idx, catalog, timeout,
+                                                                 img_data.get('content_type'))
             except Exception as e:
-                logging.error(f"error processing image {idx}: {str(e)}", exc_info=True)
-
-        if len(new_data) > 1:  
-            logging.info(f"adding {len(new_data)-1} new rows to spreadsheet...")
-            if data_process.update_google_sheets(sheet_id, new_data, SERVICE_ACCOUNT_FILE):
-                logging.info("successfully added new data to spreadsheet")
-                
-                #update processed_emails list
-                processed_emails.update(email['id'] for email in new_emails)
-                data_process.update_processed_emails(sheet_id, processed_emails, SERVICE_ACCOUNT_FILE)
-
-                # create analytics tab
-                data_process.create_analytics_sheet(sheet_id, SERVICE_ACCOUNT_FILE)
-
-                # share sheet
-                data_process.share_google_sheet(sheet_id, YOUR_EMAIL, SERVICE_ACCOUNT_FILE)
+                logger.error("error processing image %d: %s", idx, e, exc_info=True)
+                outcome['error'] = f"ocr failed: {e}"
+                continue
+            logger.debug("image processing result for image %d: %s", idx, res_data)
+
+            if not res_data:
+                logger.warning("no data extracted from image %d or its email", idx)
+                continue
+
+            if statuses is not None:
+                statuses.mark([img_data['email_id']], message_status.OCR_OK)
+            record_rows(outcome, img_data, res_data, deduplicator)
+
+        except Exception as e:
+            logger.error("error processing image %d: %s", idx, e, exc_info=True)
+            outcome['error'] = str(e)
+
+    for email_id, outcome in emails.items():
+        # a re-sent attachment only accounts for an email when nothing else in it
+        # could have had rows; otherwise the email stands on its other images
+        if outcome['duplicates'] and outcome['duplicates'] == outcome['read']:
+            outcome['handled'] = True
+        if not outcome['error']:
+            new_data.extend(outcome['rows'])
+            if not outcome['handled']:
+                logger.info("no waste rows found in the images or text of email %s", email_id)
+            if statuses is not None:
+                statuses.mark([email_id], message_status.PARSED if outcome['handled'] else message_status.NO_DATA)
+            continue
+
+        if statuses is not None:
+            statuses.fail([email_id], outcome['error'])
+        if deduplicator:
+            deduplicator.discard_email(email_id)
+
+    return new_data
+
+
+def open_writer(sheet_id, processed_emails, chain):
+    index = data_process.get_dedup_index(sheet_id, SERVICE_ACCOUNT_FILE)
+    statuses = message_status.MessageStatus()
+    writer = data_process.SheetWriter(sheet_id, SERVICE_ACCOUNT_FILE, processed_emails, index, statuses)
+    return writer, dedup.Deduplicator(index, sheet_id, writer, chain['dedup_policy'])
+
+
+# extracts a batch's rows and queues them on the writer; returns (ok, rows queued).
+# emails whose rows were all duplicates, or that had no waste rows, still count
+# as processed; failed ones don't
+def stage_batch(writer, deduplicator, img_attachments, chain, batch_ids):
+    statuses = writer.statuses
+    statuses.mark(batch_ids, message_status.FETCHED, chain['name'])
+    new_data = writer.kept(extract_rows(img_attachments, chain['menu_catalog'], deduplicator, statuses))
+
+    status = statuses.status_of(batch_ids)
+    done_ids = [msg_id for msg_id in batch_ids if status.get(msg_id) in (message_status.PARSED, message_status.NO_DATA)]
+    failed = sum(1 for msg_id in batch_ids if status.get(msg_id) == message_status.FAILED)
+    if failed:
+        logging.warning(f"{failed} emails for {chain['name']} moved to the retry queue")
+
+    if not new_data and not done_ids:
+        logging.warning("no new data to add to spreadsheet")
+        return True, []
+
+    logging.info(f"queueing {len(new_data)} new rows for {chain['name']} from {len(done_ids)} emails...")
+    return writer.add(new_data, done_ids), new_data
+
+
+def get_chain_sheet(chain):
+    return data_process.get_or_create_spreadsheet(chain['spreadsheet'], SERVICE_ACCOUNT_FILE, chain['config_file'])
+
+
+# rebuilds analytics and shares the sheet only when the last run's state says they're stale
+def refresh_outputs(sheet_id, state, chain):
+    # create analytics tab
+    state['data_hash'] = data_process.create_analytics_sheet(sheet_id, SERVICE_ACCOUNT_FILE, state.get('data_hash'))
+
+    # share sheet
+    shared_with = state.setdefault('shared_with', [])
+    for email_address in [YOUR_EMAIL] + chain['share_with']:
+        if email_address not in shared_with and data_process.share_google_sheet(sheet_id, email_address, SERVICE_ACCOUNT_FILE):
+            shared_with.append(email_address)
+
+    run_state.save_run_state(state, chain['state_file'])
+
+
+# works out which of a chain's emails still need processing; returns None when there's nothing to do
+def plan_chain(gmail_service, chain, start_time):
+    logging.info(f"checking emails for {chain['name']}...")
+    emails = email_access.search_messages(gmail_service, tenants.chain_query(chain))
+    if not emails:
+        logging.warning(f"no emails found for {chain['name']}")
+        return None
+
+    # same matching emails as last run means nothing downstream can have changed
+    state = run_state.load_run_state(chain['state_file'])
+    email_ids_hash = run_state.hash_values(sorted(msg['id'] for msg in emails))
+    if email_ids_hash == state.get('email_ids_hash'):
+        logging.info(f"mailbox unchanged since last run for {chain['name']} ({time.perf_counter() - start_time:.2f}s)")
+        return None
+
+    sheet_id = get_chain_sheet(chain)
+    if not sheet_id:
+        logging.error(f"failed to get or create spreadsheet for {chain['name']}")
+        return None
+
+    processed_emails = data_process.get_processed_emails(sheet_id, SERVICE_ACCOUNT_FILE)
+    # failed emails wait in the dead-letter queue for retry.py
+    dead_letters = message_status.MessageStatus().dead_letters()
+    new_ids = [email['id'] for email in emails
+               if email['id'] not in processed_emails and email['id'] not in dead_letters]
+
+    if not new_ids:
+        logging.info(f"no new emails to process for {chain['name']} ({time.perf_counter() - start_time:.2f}s)")
+        state['email_ids_hash'] = email_ids_hash
+        refresh_outputs(sheet_id, state, chain)
+        return None
+
+    logging.info(f"found {len(new_ids)} new emails to process for {chain['name']}")
+    return {
+        'chain': chain,
+        'sheet_id': sheet_id,
+        'state': state,
+        'email_ids_hash': email_ids_hash,
+        'new_ids': new_ids,
+        'batches': [new_ids[i:i + BATCH_SIZE] for i in range(0, len(new_ids), BATCH_SIZE)],
+        'processed_emails': processed_emails,
+        'failed': False
+    }
+
+
+def main():
+    start_time = time.perf_counter()
+    setup_logging()
+
+    try:
+        logging.info("authenticating gmail...")
+        gmail_service = email_access.get_gmail_service(CLIENT_SECRET_FILE)
+
+        chains = tenants.load_tenants()
+        sender_map = tenants.build_sender_map(chains)
+
+        work = {}
+        for chain in chains:
+            plan = plan_chain(gmail_service, chain, start_time)
+            if plan:
+                plan['writer'], plan['deduplicator'] = open_writer(plan['sheet_id'], plan['processed_emails'], chain)
+                work[chain['name']] = plan
+
+        for chain_name, batch_ids in tenants.round_robin({name: plan['batches'] for name, plan in work.items()}):
+            plan = work[chain_name]
+            logging.info(f"fetching {len(batch_ids)} {chain_name} emails...")
+            img_attachments = email_access.get_images(gmail_service, batch_ids, gmail_service, sender_map)
+            if not img_attachments:
+                logging.warning("none of the emails could be fetched")
+                continue
+
+            ok, _ = stage_batch(plan['writer'], plan['deduplicator'], img_attachments, plan['chain'], batch_ids)
+            if not ok:
+                plan['failed'] = True
+
+        ocr_scheduler.log_prefilter_summary()
+
+        for plan in work.values():
+            chain = plan['chain']
+            # leave the old hash in place so a failed chain is retried on the next run
+            if not plan['writer'].close() or plan['failed']:
+                logging.error(f"failed to add new data to spreadsheet for {chain['name']}")
+                continue
+
+            # the mailbox only counts as seen once every new email was committed or
+            # queued for retry; skipped batches or failed fetches are looked at again
+            status = plan['writer'].statuses.status_of(plan['new_ids'])
+            unfinished = sum(1 for msg_id in plan['new_ids']
+                             if status.get(msg_id) not in message_status.FINAL)
+            if unfinished:
+                logging.warning(f"{unfinished} emails for {chain['name']} weren't processed, checking them again next run")
+            else:
+                plan['state']['email_ids_hash'] = plan['email_ids_hash']
+            if plan['writer'].rows_written or plan['writer'].counts_updated:
+                refresh_outputs(plan['sheet_id'], plan['state'], chain)
+                forecast.update_forecast(plan['sheet_id'], plan['writer'].written, chain['forecast_file'], SERVICE_ACCOUNT_FILE)
             else:
-                logging.error("failed to add new data to spreadsheet")
-        else:
-            logging.warning("no new data to add to spreadsheet")
+                logging.warning(f"no new data to add to spreadsheet for {chain['name']}")
+                run_state.save_run_state(plan['state'], chain['state_file'])
 
     except Exception as e:
         logging.error(f"error: {str(e)}", exc_info=True)
+    finally:
+        profiling.write_reports()
+
+
+# --profile is passed on through the environment, so worker processes profile themselves too
+def add_profile_argument(parser):
+    parser.add_argument('--profile', action='store_true',
+                        help="profile each pipeline stage and write the reports to the logs directory")
+
+
+def apply_profile_argument(args):
+    if args.profile:
+        os.environ[profiling.PROFILE_ENV] = '1'
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="process new waste emails into the spreadsheet")
+    add_profile_argument(parser)
+    apply_profile_argument(parser.parse_args())
     main()
\ No newline at end of file
@@ -0,0 +1,84 @@
+import datetime
+import logging
+import sqlite3
+import time
+
+STATUS_DB = 'message_status.db'
+MAX_ATTEMPTS = 5  # failed emails are retried this many times, then left for a person to look at
+RETRY_BACKOFF = 15 * 60  # seconds before the first retry, doubled after each failed attempt
+
+# an email moves fetched -> ocr_ok -> parsed -> committed, or to failed with a reason.
+# one that was read cleanly but had no waste rows ends at no_data; like committed
+# ones it is recorded in ProcessedEmails and never read again.
+# failed emails are the dead-letter queue: the normal runs leave them alone and
+# retry.py picks them up once their backoff has passed
+FETCHED = 'fetched'
+OCR_OK = 'ocr_ok'
+PARSED = 'parsed'
+COMMITTED = 'committed'
+FAILED = 'failed'
+NO_DATA = 'no_data'
+FINAL = (COMMITTED, NO_DATA, FAILED)  # statuses an email won't leave without another run picking it up
+
+logger = logging.getLogger('breadbot.pipeline')
+
+
+class MessageStatus:
+    def __init__(self, path=STATUS_DB):
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS messages (
+                email_id TEXT PRIMARY KEY, chain TEXT, status TEXT, reason TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0, next_retry REAL, updated_at TEXT
+            ) WITHOUT ROWID
+        ''')
+
+    def mark(self, email_ids, status, chain=None):
+        now = datetime.datetime.now().isoformat()
+        with self.conn:
+            self.conn.executemany('''
+                INSERT INTO messages (email_id, chain, status, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (email_id) DO UPDATE SET
+                    chain = COALESCE(excluded.chain, chain), status = excluded.status,
+                    reason = NULL, next_retry = NULL, updated_at = excluded.updated_at
+            ''', [(email_id, chain, status, now) for email_id in email_ids])
+
+    def fail(self, email_ids, reason, chain=None):
+        now = datetime.datetime.now()
+        with self.conn:
+            for email_id in email_ids:
+                row = self.conn.execute('SELECT attempts FROM messages WHERE email_id = ?', (email_id,)).fetchone()
+                attempts = (row[0] if row else 0) + 1
+                next_retry = time.time() + RETRY_BACKOFF * 2 ** (attempts - 1) if attempts < MAX_ATTEMPTS else None
+                self.conn.execute('''
+                    INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (email_id) DO UPDATE SET
+                        chain = COALESCE(excluded.chain, chain), status = excluded.status, reason = excluded.reason,
+                        attempts = excluded.attempts, next_retry = excluded.next_retry, updated_at = excluded.updated_at
+                ''', (email_id, chain, FAILED, reason, attempts, next_retry, now.isoformat()))
+                logger.warning("email %s failed (attempt %d): %s", email_id, attempts, reason)
+
+    def status_of(self, email_ids):
+        placeholders = ','.join('?' * len(email_ids))
+        return dict(self.conn.execute(
+            f'SELECT email_id, status FROM messages WHERE email_id IN ({placeholders})', list(email_ids)
+        ).fetchall()) if email_ids else {}
+
+    def dead_letters(self):
+        return {email_id for (email_id,) in
+                self.conn.execute('SELECT email_id FROM messages WHERE status = ?', (FAILED,))}
+
+    # {chain name: [email ids]} for failed emails whose backoff has passed
+    def due(self, now=None):
+        due = {}
+        for email_id, chain in self.conn.execute(
+                'SELECT email_id, chain FROM messages WHERE status = ? AND next_retry <= ? ORDER BY next_retry',
+                (FAILED, now or time.time())):
+            due.setdefault(chain, []).append(email_id)
+        return due
+
+    def failures(self):
+        return self.conn.execute(
+            'SELECT email_id, chain, reason, attempts, updated_at FROM messages WHERE status = ? ORDER BY updated_at',
+            (FAILED,)
+        ).fetchall()
@@ -0,0 +1,136 @@
+import logging
+from io import BytesIO
+
+# rough tesseract cost model, in seconds per OCR pass
+BASE_COST = 1.0
+SECONDS_PER_MEGAPIXEL = 0.8  # a clean 12MP phone photo comes out around 10s
+LOW_CONTRAST = 40  # grey-level stddev below this reads like a washed-out photo
+LOW_SHARPNESS = 6  # mean edge strength below this reads like a blurry one
+DIFFICULTY_PENALTY = 1.0  # extra cost factor for each of low contrast / low sharpness
+THUMBNAIL_SIZE = (256, 256)
+
+# pre-filter for images that can't be a receipt (signature logos, emoji, banners,
+# blank scans). they skip OCR entirely, which would otherwise spend both rotation
+# passes before calling them invalid
+MIN_RECEIPT_SIDE = 200  # pixels on the short side
+MAX_ASPECT_RATIO = 8
+EDGE_THRESHOLD = 32  # thumbnail edge strength that counts as a text stroke
+MIN_TEXT_DENSITY = 0.01  # fraction of thumbnail pixels on a stroke
+OCR_PASSES_PER_REJECT = 2  # an invalid image used to be read at 0 and 180 degrees
+
+# timeouts get TIMEOUT_HEADROOM times the estimate, clamped to the lane's range.
+# images estimated above SLOW_LANE_COST run after everything else in the batch
+TIMEOUT_HEADROOM = 3
+MIN_TIMEOUT = 10
+MAX_TIMEOUT = 30
+SLOW_LANE_COST = 20
+SLOW_TIMEOUT = 120
+
+# lanes returned by schedule()
+FAST = 'fast'
+SLOW = 'slow'
+SKIP = 'skip'
+
+logger = logging.getLogger('breadbot.ocr')
+
+prefilter_stats = {'screened': 0, 'rejected': 0}
+
+
+# (width, height, contrast, sharpness, text density) from a small greyscale thumbnail;
+# JPEGs are decoded at reduced scale, so this costs a few milliseconds even for large photos
+def image_metrics(image_stream):
+    from PIL import Image, ImageFilter, ImageStat
+
+    image_stream.seek(0)
+    with Image.open(image_stream) as image:
+        width, height = image.size
+        image.draft('L', (max(width // 8, 1), max(height // 8, 1)))
+        thumbnail = image.convert('L')
+    image_stream.seek(0)
+
+    thumbnail.thumbnail(THUMBNAIL_SIZE)
+    contrast = ImageStat.Stat(thumbnail).stddev[0]
+    edges = thumbnail.filter(ImageFilter.FIND_EDGES)
+    sharpness = ImageStat.Stat(edges).mean[0]
+    text_density = ImageStat.Stat(edges.point(lambda value: 255 if value > EDGE_THRESHOLD else 0)).mean[0] / 255
+    return width, height, contrast, sharpness, text_density
+
+
+# returns why an image can't be a receipt, or None if it might be one
+def reject_reason(width, height, text_density):
+    if min(width, height) < MIN_RECEIPT_SIDE:
+        return f"too small ({width}x{height})"
+    if max(width, height) / min(width, height) > MAX_ASPECT_RATIO:
+        return f"banner-shaped ({width}x{height})"
+    if text_density < MIN_TEXT_DENSITY:
+        return f"no text-like edges ({text_density:.3f})"
+    return None
+
+
+def estimate_cost(megapixels, contrast, sharpness):
+    difficulty = 1.0
+    if contrast < LOW_CONTRAST:
+        difficulty += DIFFICULTY_PENALTY
+    if sharpness < LOW_SHARPNESS:
+        difficulty += DIFFICULTY_PENALTY
+    return (BASE_COST + SECONDS_PER_MEGAPIXEL * megapixels) * difficulty
+
+
+def timeout_for(cost, slow=False):
+    low, high = (MAX_TIMEOUT, SLOW_TIMEOUT) if slow else (MIN_TIMEOUT, MAX_TIMEOUT)
+    return min(max(cost * TIMEOUT_HEADROOM, low), high)
+
+
+# returns [(index, img_data, lane, timeout)]: images the pre-filter rejected first
+# (lane SKIP, no OCR), then the fast lane ordered cheapest first, then the slow
+# lane, so one huge or blurry photo can't hold up the rest.
+# index is the image's 1-based position in arrival order, for logging
+def schedule(img_attachments):
+    skipped, fast, slow = [], [], []
+    for index, img_data in enumerate(img_attachments, start=1):
+        stream = img_data.get('stream')
+        # PDFs can't be measured without rasterizing them, and are usually multi-page scans
+        if img_data.get('content_type') == 'application/pdf':
+            slow.append((SLOW_LANE_COST, index, img_data))
+            continue
+        try:
+            if not isinstance(stream, BytesIO):
+                raise ValueError("no image stream")
+            width, height, contrast, sharpness, text_density = image_metrics(stream)
+        except Exception as e:
+            # unreadable images fail fast in OCR anyway
+            logger.debug("no cost estimate for image %d: %s", index, e)
+            fast.append((0, index, img_data))
+            continue
+
+        prefilter_stats['screened'] += 1
+        reason = reject_reason(width, height, text_density)
+        if reason:
+            prefilter_stats['rejected'] += 1
+            logger.debug("image %d (%s) is not a receipt: %s", index, img_data.get('filename'), reason)
+            skipped.append((index, img_data, SKIP, 0))
+            continue
+
+        cost = estimate_cost(width * height / 1e6, contrast, sharpness)
+        lane = slow if cost > SLOW_LANE_COST else fast
+        lane.append((cost, index, img_data))
+
+    fast.sort(key=lambda entry: entry[0])
+    slow.sort(key=lambda entry: entry[0])
+    if slow:
+        logger.info("scheduled %d images: %d fast (~%.0fs), %d in the slow lane (~%.0fs)",
+                    len(fast) + len(slow), len(fast), sum(entry[0] for entry in fast),
+                    len(slow), sum(entry[0] for entry in slow))
+
+    return (skipped +
+            [(index, img_data, FAST, timeout_for(cost)) for cost, index, img_data in fast] +
+            [(index, img_data, SLOW, timeout_for(cost, slow=True)) for cost, index, img_data in slow])
+
+
+# logs what the pre-filter saved since the last call and starts counting again
+def log_prefilter_summary():
+    if prefilter_stats['screened']:
+        logger.info("pre-filter screened %d images, skipped %d non-receipts, saving %d OCR passes",
+                    prefilter_stats['screened'], prefilter_stats['rejected'],
+                    prefilter_stats['rejected'] * OCR_PASSES_PER_REJECT)
+    prefilter_stats['screened'] = prefilter_stats['rejected'] = 0
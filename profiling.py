@@ -0,0 +1,184 @@
+import cProfile
+import datetime
+import functools
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+# `python main.py --profile` (or BREADBOT_PROFILE=1, which worker processes
+# inherit) wraps each pipeline stage below. per stage, it writes into
+# logs/profile_<date>_<time>_<pid>/:
+#   <stage>.collapsed   sampled stacks in collapsed format, for flamegraph.pl or speedscope
+#   <stage>.prof        cProfile stats, for pstats or snakeviz
+#   summary.txt         wall time, calls and the top functions of every stage
+PROFILE_ENV = 'BREADBOT_PROFILE'
+SAMPLE_INTERVAL = 0.005  # seconds between stack samples
+TOP_N = 25  # functions listed per stage in summary.txt
+
+# (module, attribute, stage). methods are given as 'Class.method'. calls made
+# while another stage is running on the same thread count towards the outer stage
+STAGES = [
+    ('email_access', 'search_messages_with_status', 'search_messages'),
+    ('email_access', 'get_images', 'get_images'),
+    ('img_process', 'process_image_from_stream', 'process_image_from_stream'),
+    ('img_process', 'process_image', 'process_image_from_stream'),
+    ('img_process', 'parse_text', 'parse_text'),
+    ('data_process', 'SheetWriter.flush', 'sheet_writer'),
+    ('data_process', 'update_processed_emails', 'sheet_writer'),
+    ('data_process', 'create_analytics_sheet', 'create_analytics_sheet'),
+    ('forecast', 'update_forecast', 'update_forecast'),
+]
+
+logger = logging.getLogger('breadbot.pipeline')
+
+
+class StageProfiler:
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.active = {}  # thread id -> stage, read by the sampler
+        self.stats = {}  # stage -> merged pstats.Stats
+        self.wall = defaultdict(float)
+        self.calls = Counter()
+        self.stacks = defaultdict(Counter)  # stage -> collapsed stack -> samples
+        self.sampler = threading.Thread(target=self.sample, name='profile-sampler', daemon=True)
+        self.sampler.start()
+
+    def run(self, stage, func, args, kwargs):
+        if getattr(self.local, 'stage', None):
+            return func(*args, **kwargs)
+
+        thread_id = threading.get_ident()
+        self.local.stage = stage
+        self.active[thread_id] = stage
+        # only one cProfile can run at a time on newer Pythons, so threads other
+        # than the main one (OCR page workers) are only sampled. their time is
+        # already inside the main thread's call that started them
+        on_main_thread = threading.current_thread() is threading.main_thread()
+        profiler = cProfile.Profile() if on_main_thread else None
+        start = time.perf_counter()
+        if profiler:
+            profiler.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if profiler:
+                profiler.disable()
+            elapsed = time.perf_counter() - start
+            self.local.stage = None
+            self.active.pop(thread_id, None)
+            if on_main_thread:
+                with self.lock:
+                    self.wall[stage] += elapsed
+                    self.calls[stage] += 1
+                    if stage in self.stats:
+                        self.stats[stage].add(profiler)
+                    else:
+                        self.stats[stage] = pstats.Stats(profiler)
+
+    def sample(self):
+        while True:
+            time.sleep(SAMPLE_INTERVAL)
+            frames = sys._current_frames()
+            for thread_id, stage in list(self.active.items()):
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    stack = collapse(frame)
+                    with self.lock:
+                        self.stacks[stage][stack] += 1
+
+    def write_reports(self):
+        os.makedirs(self.out_dir, exist_ok=True)
+        summary = io.StringIO()
+        with self.lock:
+            for stage in sorted(self.wall, key=self.wall.get, reverse=True):
+                summary.write(f"== {stage}: {self.calls[stage]} calls, {self.wall[stage]:.2f}s wall ==\n")
+                with open(os.path.join(self.out_dir, f'{stage}.collapsed'), 'w') as f:
+                    for stack, count in self.stacks[stage].most_common():
+                        f.write(f"{stack} {count}\n")
+
+                stats = self.stats.get(stage)
+                if stats is None:
+                    summary.write("(sampled only)\n\n")
+                    continue
+                stats.dump_stats(os.path.join(self.out_dir, f'{stage}.prof'))
+                stats.stream = summary
+                stats.sort_stats('cumulative').print_stats(TOP_N)
+                stats.sort_stats('tottime').print_stats(TOP_N)
+
+        with open(os.path.join(self.out_dir, 'summary.txt'), 'w') as f:
+            f.write(summary.getvalue())
+        logger.info("profile written to %s (%s)", self.out_dir,
+                    ', '.join(f"{stage} {seconds:.1f}s" for stage, seconds in
+                              sorted(self.wall.items(), key=lambda entry: entry[1], reverse=True)))
+
+
+# outermost frame first, as flamegraph tools expect; the profiler's own wrapper frames are left out
+def collapse(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        if code.co_filename != __file__:
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+profiler = None
+patched = False
+
+
+def wrap(stage, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if profiler is None:
+            return func(*args, **kwargs)
+        return profiler.run(stage, func, args, kwargs)
+    return wrapper
+
+
+def new_profiler(log_dir):
+    stamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+    return StageProfiler(os.path.join(log_dir, f'profile_{stamp}_{os.getpid()}'))
+
+
+# a forked worker (backfill's pool) gets its own samples, sampler thread and output directory
+def restart_after_fork():
+    global profiler
+    if profiler is not None:
+        profiler = new_profiler(os.path.dirname(profiler.out_dir))
+
+
+def enable(log_dir):
+    global profiler, patched
+    if profiler is not None:
+        return
+    import importlib
+
+    profiler = new_profiler(log_dir)
+    if not patched:
+        for module_name, attribute, stage in STAGES:
+            owner = importlib.import_module(module_name)
+            *path, name = attribute.split('.')
+            for part in path:
+                owner = getattr(owner, part)
+            setattr(owner, name, wrap(stage, getattr(owner, name)))
+        os.register_at_fork(after_in_child=restart_after_fork)
+        patched = True
+    logger.info("profiling enabled, writing to %s", profiler.out_dir)
+
+
+def enable_from_env(log_dir):
+    if os.environ.get(PROFILE_ENV, '').strip() in ('1', 'true', 'yes'):
+        enable(log_dir)
+
+
+def write_reports():
+    if profiler is not None:
+        profiler.write_reports()
@@ -0,0 +1,43 @@
+import datetime
+import sys
+
+UNIX_EPOCH = datetime.date(1970, 1, 1).toordinal()
+
+
+# one waste line from parser to writer. the date is kept as a proleptic ordinal
+# and store/item names are interned, so a large backfill holds one small object
+# per row instead of a list of separate strings. Sheets values, MM/DD/YYYY
+# strings and dedup keys are only produced at the edges
+class WasteRecord:
+    __slots__ = ('date', 'location', 'item', 'count', 'confidence')
+
+    def __init__(self, date, item, count, location=None, confidence=None):
+        self.date = date
+        self.location = sys.intern(location) if location else location
+        self.item = sys.intern(item)
+        self.count = count
+        self.confidence = confidence
+
+    def set_location(self, location):
+        self.location = sys.intern(location)
+
+    @property
+    def day(self):
+        return datetime.date.fromordinal(self.date)
+
+    @property
+    def date_string(self):
+        return self.day.strftime("%m/%d/%Y")
+
+    def sheet_values(self):
+        day = self.day
+        return [f'=DATE({day.year}, {day.month}, {day.day})', self.location or '', self.item, self.count]
+
+    def __eq__(self, other):
+        if not isinstance(other, WasteRecord):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self):
+        confidence = '' if self.confidence is None else f', confidence={self.confidence}'
+        return f"WasteRecord({self.date_string}, {self.location!r}, {self.item!r}, {self.count}{confidence})"
@@ -0,0 +1,68 @@
+import main
+import daemon
+import email_access
+import data_process
+import message_status
+import tenants
+import profiling
+import argparse
+import logging
+
+
+# drains the dead-letter queue: every failed email whose backoff has passed is
+# run through the normal pipeline again. meant for its own cron line, e.g. hourly
+def retry():
+    statuses = message_status.MessageStatus()
+    due = statuses.due()
+    if not due:
+        logging.info("no failed emails due for retry")
+        return
+
+    logging.info("authenticating gmail...")
+    gmail_service = email_access.get_gmail_service(main.CLIENT_SECRET_FILE)
+    chains = {chain['name']: chain for chain in tenants.load_tenants()}
+    sender_map = tenants.build_sender_map(chains.values())
+
+    for chain_name, msg_ids in due.items():
+        chain = chains.get(chain_name)
+        if not chain:
+            logging.warning(f"{len(msg_ids)} failed emails belong to unknown chain {chain_name}, leaving them queued")
+            continue
+        sheet_id = main.get_chain_sheet(chain)
+        if not sheet_id:
+            logging.error(f"failed to get or create spreadsheet for {chain_name}, skipping it")
+            continue
+
+        sheet = {
+            'chain': chain,
+            'sheet_id': sheet_id,
+            'processed_emails': data_process.get_processed_emails(sheet_id, main.SERVICE_ACCOUNT_FILE)
+        }
+        already_written = [msg_id for msg_id in msg_ids if msg_id in sheet['processed_emails']]
+        statuses.mark(already_written, message_status.COMMITTED)
+        msg_ids = [msg_id for msg_id in msg_ids if msg_id not in sheet['processed_emails']]
+
+        logging.info(f"retrying {len(msg_ids)} failed emails for {chain_name}")
+        # emails it can't fetch are failed again there, counting the attempt
+        for i in range(0, len(msg_ids), main.BATCH_SIZE):
+            daemon.process_new_emails(gmail_service, sheet, msg_ids[i:i + main.BATCH_SIZE], sender_map)
+    profiling.write_reports()
+
+
+def list_failures():
+    for email_id, chain, reason, attempts, updated_at in message_status.MessageStatus().failures():
+        print(f"{updated_at}  {chain}  {email_id}  attempts={attempts}  {reason}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="retry emails that failed to process")
+    parser.add_argument('--list', action='store_true', help="list the failed emails instead of retrying them")
+    main.add_profile_argument(parser)
+    args = parser.parse_args()
+    main.apply_profile_argument(args)
+
+    if args.list:
+        list_failures()
+    else:
+        main.setup_logging()
+        retry()
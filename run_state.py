@@ -0,0 +1,31 @@
+import hashlib
+import json
+import logging
+import os
+
+RUN_STATE_FILE = 'run_state.json'
+
+
+# remembers what the last run saw so unchanged work can be skipped:
+#   email_ids_hash - hash of the matching gmail message ids
+#   data_hash - hash of the Sheet1 contents the analytics tab was built from
+#   shared_with - addresses the spreadsheet has already been shared with
+def load_run_state(path=RUN_STATE_FILE):
+    if os.path.exists(path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"ignoring unreadable run state file: {e}")
+    return {}
+
+
+def save_run_state(state, path=RUN_STATE_FILE):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def hash_values(values):
+    return hashlib.sha256(json.dumps(values, sort_keys=True).encode('utf-8')).hexdigest()
@@ -0,0 +1,99 @@
+import json
+import logging
+import os
+import re
+from email.utils import parseaddr
+from functools import lru_cache
+
+TENANTS_FILE = 'tenants.json'
+
+# used when there's no tenants.json - the original single chain with four stores.
+# tenants.json has the same shape: chains -> stores -> sender addresses, plus the
+# chain's spreadsheet title, an optional menu catalog of {"ocr misread": "menu name"}
+# and an optional dedup_policy (see dedup.POLICIES)
+DEFAULT_TENANTS = {
+    'chains': [
+        {
+            'name': 'MB',
+            'spreadsheet': 'MB Inventory Sheet',
+            'config_file': 'mb_inventory_config.json',
+            'state_file': 'run_state.json',
+            'forecast_file': 'forecast_state.json',
+            'stores': [
+                {'name': 'location1', 'senders': ['location1@company.com']},
+                {'name': 'location2', 'senders': ['location2@company.com']},
+                {'name': 'location3', 'senders': ['location3@company.com']},
+                {'name': 'location4', 'senders': ['location4@company.com']},
+            ]
+        }
+    ]
+}
+
+
+def slugify(name):
+    return re.sub(r'[^a-z0-9]+', '_', name.lower()).strip('_')
+
+
+def load_tenants(path=TENANTS_FILE):
+    config = DEFAULT_TENANTS
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            config = json.load(f)
+
+    chains = []
+    for chain in config['chains']:
+        slug = slugify(chain['name'])
+        chains.append({
+            'menu_catalog': {},
+            'dedup_policy': 'keep_latest',
+            'share_with': [],
+            'config_file': f'{slug}_inventory_config.json',
+            'state_file': f'run_state_{slug}.json',
+            'forecast_file': f'forecast_state_{slug}.json',
+            **chain
+        })
+    return chains
+
+
+# precomputed sender address -> (chain name, store name), so routing a message is one dict lookup
+def build_sender_map(chains):
+    sender_map = {}
+    for chain in chains:
+        for store in chain['stores']:
+            for sender in store['senders']:
+                address = sender.lower()
+                if address in sender_map:
+                    logging.warning(f"sender {address} is listed for more than one store, using {store['name']}")
+                sender_map[address] = (chain['name'], store['name'])
+    return sender_map
+
+
+@lru_cache(maxsize=None)
+def get_sender_map(path=TENANTS_FILE):
+    return build_sender_map(load_tenants(path))
+
+
+# returns (chain name, store name) for a From header, or None for unknown senders
+def resolve_sender(from_header, sender_map):
+    _, address = parseaddr(from_header)
+    return sender_map.get(address.lower())
+
+
+def chain_senders(chain):
+    return [sender for store in chain['stores'] for sender in store['senders']]
+
+
+def chain_query(chain):
+    return ' OR '.join(f'from:{sender}' for sender in chain_senders(chain))
+
+
+# yields (key, item) taking one item from each queue in turn, so a chain with a
+# big backlog doesn't hold up every other chain until it's finished
+def round_robin(queues):
+    iterators = {key: iter(items) for key, items in queues.items()}
+    while iterators:
+        for key in list(iterators):
+            try:
+                yield key, next(iterators[key])
+            except StopIteration:
+                del iterators[key]
@@ -0,0 +1,130 @@
+import datetime
+import fcntl
+import json
+import logging
+import os
+import pickle
+import sys
+import time
+from contextlib import contextmanager
+
+TOKEN_FILE = 'token.json'
+LEGACY_TOKEN_FILE = 'token.pickle'  # written by older versions, migrated to TOKEN_FILE on first use
+REFRESH_MARGIN = datetime.timedelta(minutes=5)  # refresh this long before the access token expires
+LOCK_TIMEOUT = 60  # seconds to wait for another process to finish refreshing
+# BREADBOT_INTERACTIVE=1 allows the browser sign-in even without a terminal, =0 forbids it
+INTERACTIVE_ENV = 'BREADBOT_INTERACTIVE'
+
+
+class CredentialError(Exception):
+    pass
+
+
+def is_interactive():
+    setting = os.environ.get(INTERACTIVE_ENV)
+    if setting is not None:
+        return setting.strip().lower() in ('1', 'true', 'yes')
+    return sys.stdin is not None and sys.stdin.isatty()
+
+
+# exclusive lock on <token file>.lock shared by every process using the token, so
+# only one of them refreshes it and the others read the result. gives up after
+# LOCK_TIMEOUT rather than waiting forever on a stuck process
+@contextmanager
+def token_lock(token_file, timeout=LOCK_TIMEOUT):
+    with open(f"{token_file}.lock", 'w') as lock_file:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    raise CredentialError(f"timed out waiting for the lock on {token_file}")
+                time.sleep(0.2)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def read_token(token_file, scopes):
+    from google.oauth2.credentials import Credentials
+
+    if not os.path.exists(token_file):
+        return None
+    try:
+        with open(token_file, 'r') as f:
+            return Credentials.from_authorized_user_info(json.load(f), scopes)
+    except (OSError, ValueError) as e:
+        logging.warning(f"ignoring unreadable token file {token_file}: {e}")
+        return None
+
+
+# written to a private temp file and renamed into place, so a reader never sees half a token
+def write_token(creds, token_file):
+    tmp_path = f"{token_file}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(creds.to_json())
+    os.replace(tmp_path, token_file)
+
+
+def migrate_legacy_token(token_file, legacy_file=LEGACY_TOKEN_FILE):
+    if os.path.exists(token_file) or not os.path.exists(legacy_file):
+        return
+    try:
+        with open(legacy_file, 'rb') as f:
+            creds = pickle.load(f)
+        write_token(creds, token_file)
+        logging.info(f"migrated {legacy_file} to {token_file}, the old file can be deleted")
+    except Exception as e:
+        logging.warning(f"could not migrate {legacy_file}: {e}")
+
+
+def needs_refresh(creds):
+    if not creds.valid:
+        return True
+    # google-auth keeps expiry as naive UTC
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    return creds.expiry is not None and creds.expiry - now < REFRESH_MARGIN
+
+
+# returns valid credentials, refreshing them shortly before they expire. the token
+# is re-read under the lock, so when several processes start together only the
+# first refreshes and the rest pick up its token. without a terminal (cron,
+# backfill workers) a missing or revoked token raises CredentialError instead
+# of opening a browser and waiting forever
+def get_credentials(client_secret_file, scopes, token_file=TOKEN_FILE, interactive=None):
+    from google.auth.exceptions import RefreshError
+    from google.auth.transport.requests import Request
+
+    if interactive is None:
+        interactive = is_interactive()
+
+    with token_lock(token_file):
+        migrate_legacy_token(token_file)
+        creds = read_token(token_file, scopes)
+        if creds and not needs_refresh(creds):
+            return creds
+
+        if creds and creds.refresh_token:
+            try:
+                logging.info("refreshing gmail token")
+                creds.refresh(Request())
+                write_token(creds, token_file)
+                return creds
+            except RefreshError as e:
+                logging.warning(f"gmail token refresh failed: {e}")
+
+        if not interactive:
+            raise CredentialError(f"no valid gmail token in {token_file} and no terminal to sign in from; "
+                                  f"run `python main.py` from a terminal once to authorize")
+
+        from google_auth_oauthlib.flow import InstalledAppFlow
+
+        logging.info("getting new gmail token")
+        flow = InstalledAppFlow.from_client_secrets_file(client_secret_file, scopes)
+        creds = flow.run_local_server(port=0)
+        write_token(creds, token_file)
+        return creds